@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+IDENTITY_GENERATION_KEY = "api:identity_generation"
+# Data behind cached API responses (see data_generation())
+SESSIONS = "sessions"
+TOKENS = "tokens"
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe mapping that evicts its least recently used entry.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# wallboxIO runs in its own process, so identity changes made through the admin are announced via the shared cache
+def identity_generation():
+    return cache.get(IDENTITY_GENERATION_KEY, 0)
+
+
+def bump_identity_generation():
+    try:
+        cache.incr(IDENTITY_GENERATION_KEY)
+    except ValueError:
+        cache.set(IDENTITY_GENERATION_KEY, 1, timeout=None)
+
+
+# Generations of the data behind cached API responses, bumped whenever it changes (in any process).
+# The generation is the time of the last change (in ns), so it doubles as modification time.
+def data_generation(name):
+    key = f"api:generation:{name}"
+    generation = cache.get(key)
+    if generation is None:
+        # Unknown (e.g. the cache was cleared), anything could have changed
+        cache.add(key, time.time_ns(), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_data_generation(name):
+    cache.set(f"api:generation:{name}", time.time_ns(), timeout=None)
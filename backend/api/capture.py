@@ -0,0 +1,45 @@
+import ipaddress
+import struct
+
+# Capture files start with this magic, followed by one record per datagram:
+# receive time (unix seconds, double), source IPv4 address, source port, payload length, payload
+MAGIC = b"WBCAP1\n"
+RECORD_HEADER = struct.Struct("<d4sHH")
+
+
+class CaptureWriter:
+    """
+    Appends received datagrams to a capture file. Every record is flushed right away, so a capture
+    survives a crash up to the last datagram.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write(self, timestamp, addr, data):
+        host, port = addr
+        self.file.write(RECORD_HEADER.pack(timestamp, ipaddress.IPv4Address(host).packed, port, len(data)) + data)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """
+    Yields (timestamp, address, data) for every datagram of a capture file. A truncated last record is ignored.
+    """
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, host, port, length = RECORD_HEADER.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, (str(ipaddress.IPv4Address(host)), port), data
@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from api.cache import bump_data_generation, SESSIONS
+from api.models import ChargeSession, EnergyRollup
+
+
+def add_to_energy_rollup(session):
+    """
+    Adds a newly recorded charge session to its energy rollup. Call it within the transaction recording the session.
+    """
+    # Same day as TruncDate (and the date filters of the session list): local time
+    day = timezone.localdate(session.started)
+    updated = EnergyRollup.objects.filter(day=day, token=session.token, wallbox=session.wallboxSerial).update(
+        sessions=F('sessions') + 1, chargedEnergy=F('chargedEnergy') + session.chargedEnergy)
+    if not updated:
+        EnergyRollup.objects.create(day=day, token=session.token, wallbox=session.wallboxSerial, sessions=1,
+                                    chargedEnergy=session.chargedEnergy)
+
+
+def remove_from_energy_rollup(session):
+    """
+    Takes a recorded charge session (as it was recorded) out of its energy rollup, before it is recorded again with
+    different data. Call it within the transaction changing the session.
+    """
+    rollups = EnergyRollup.objects.filter(day=timezone.localdate(session.started), token_id=session.token_id,
+                                          wallbox_id=session.wallboxSerial_id)
+    rollups.update(sessions=F('sessions') - 1, chargedEnergy=F('chargedEnergy') - session.chargedEnergy)
+    # Like a rebuild, which has no rollups without sessions
+    rollups.filter(sessions__lte=0).delete()
+
+
+def rebuild_energy_rollups():
+    """
+    Recomputes all energy rollups from the charge sessions. Returns the number of rollups.
+    """
+    rows = ChargeSession.objects.annotate(day=TruncDate('started')).order_by().values(
+        'day', 'token', 'wallboxSerial').annotate(sessionCount=Count('pk'), energy=Sum('chargedEnergy'))
+    with transaction.atomic():
+        EnergyRollup.objects.all().delete()
+        rollups = EnergyRollup.objects.bulk_create(
+            [EnergyRollup(day=row['day'], token_id=row['token'], wallbox_id=row['wallboxSerial'],
+                          sessions=row['sessionCount'], chargedEnergy=row['energy']) for row in rows],
+            batch_size=1000)
+    # Cached aggregations depend on the sessions
+    bump_data_generation(SESSIONS)
+    return len(rollups)
@@ -0,0 +1,108 @@
+import csv
+import io
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import formats, timezone
+from rest_framework import renderers
+
+# Rows are sent in chunks of this many sessions
+EXPORT_CHUNK_SIZE = 500
+
+# Exported columns: (key, header, values() field). Headers match the ones of the web interface.
+EXPORT_COLUMNS = [
+    ("token", "RFID Token", None),
+    ("started", "Beginn", "started"),
+    ("ended", "Ende", "ended"),
+    ("chargedEnergy", "Geladene Energie (Wh)", "chargedEnergy"),
+    ("wallboxSerial", "Seriennummer der Wallbox", "wallboxSerial"),
+    ("wallboxProduct", "Modell", "wallboxSerial__product"),
+]
+EXPORT_FIELDS = ["sessionID", "token__tokenID", "token__tokenClass", "token__name"] + \
+                [field for key, header, field in EXPORT_COLUMNS if field is not None]
+
+
+class ExportRenderer(renderers.BaseRenderer):
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Exports are streamed, this only renders errors
+        return json.dumps(data).encode("utf-8")
+
+
+class CSVRenderer(ExportRenderer):
+    media_type = "text/csv"
+    format = "csv"
+
+
+class NDJSONRenderer(ExportRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+
+def token_name(row):
+    # Same as tokenToString() of the web interface
+    if row["token__name"]:
+        return row["token__name"]
+    return f'{row["token__tokenID"]}/{row["token__tokenClass"]}'
+
+
+def export_values(row):
+    return [token_name(row) if field is None else row[field] for key, header, field in EXPORT_COLUMNS]
+
+
+def format_csv_value(value):
+    if value is None:
+        return ""
+    if hasattr(value, "tzinfo"):
+        return timezone.localtime(value).strftime("%Y-%m-%d %H:%M:%S")
+    if not isinstance(value, str):
+        return formats.number_format(value, use_l10n=True, force_grouping=True)
+    return value
+
+
+def csv_chunk(rows, first):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    if first:
+        # Lets spreadsheet applications detect the encoding
+        buffer.write("\ufeff")
+        writer.writerow(header for key, header, field in EXPORT_COLUMNS)
+    writer.writerows((format_csv_value(value) for value in export_values(row)) for row in rows)
+    return buffer.getvalue()
+
+
+def ndjson_line(row):
+    values = dict(zip((key for key, header, field in EXPORT_COLUMNS), export_values(row)))
+    values["sessionID"] = row["sessionID"]
+    return json.dumps(values, cls=DjangoJSONEncoder) + "\n"
+
+
+def ndjson_chunk(rows, first):
+    return "".join(ndjson_line(row) for row in rows)
+
+
+# Under ASGI, the rows come from an async iterator and the event loop sends the chunks. WSGI servers need a sync
+# iterator (they would read an async one to the end before sending anything).
+def chunks(rows, format_chunk):
+    batch = []
+    first = True
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= EXPORT_CHUNK_SIZE:
+            yield format_chunk(batch, first)
+            batch = []
+            first = False
+    yield format_chunk(batch, first)
+
+
+async def async_chunks(rows, format_chunk):
+    batch = []
+    first = True
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= EXPORT_CHUNK_SIZE:
+            yield format_chunk(batch, first)
+            batch = []
+            first = False
+    yield format_chunk(batch, first)
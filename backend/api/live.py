@@ -0,0 +1,170 @@
+import asyncio
+import contextvars
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError
+
+from api.export import ExportRenderer
+from api.metrics import REGISTRY
+from api.models import Wallbox
+from api.serializers import WallboxSerializer, ValuesSerializer
+from backend.settings import LIVE_UPDATES_PORT
+
+logger = logging.getLogger(__name__)
+
+# Idle streams get a comment this often, so proxies don't close them (seconds)
+KEEPALIVE_INTERVAL = 15
+# Clients reconnect this long after their stream ended (milliseconds)
+RECONNECT_DELAY = 5000
+# Events waiting to be sent to a client. Clients falling further behind are disconnected, they resync on reconnect.
+CLIENT_QUEUE_SIZE = 100
+# The uptime is extrapolated on every read, it doesn't make a wallbox change
+VOLATILE_FIELDS = ("uptime",)
+
+live_clients = REGISTRY.gauge("api_live_clients", "Clients connected to the live wallbox stream")
+live_events = REGISTRY.counter("api_live_events_total", "Wallbox changes sent to the live stream")
+
+
+def read_wallboxes(serials=None):
+    serializer = ValuesSerializer(WallboxSerializer())
+    queryset = Wallbox.objects.select_related('currentToken')
+    if serials is not None:
+        queryset = queryset.filter(serial__in=serials)
+    return {wallbox['serial']: wallbox for wallbox in serializer.represent(queryset.values(*serializer.values_fields))}
+
+
+def event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+class EventStreamRenderer(ExportRenderer):
+    media_type = "text/event-stream"
+    format = "event-stream"
+
+
+class WallboxBroadcaster(asyncio.DatagramProtocol):
+    """
+    Fans out wallbox changes to all clients of the live stream. wallboxIO announces the serial of every wallbox it
+    changed, the broadcaster reads the wallbox once and sends the fields that changed to every client.
+    Clients start from the broadcaster's state, so no change is lost in between. It only runs while clients are
+    connected.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        # Representation of every wallbox as last sent, and when it was read (for the uptime)
+        self.state = {}
+        self.read_at = {}
+        self.pending = set()
+        self.changed = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.transport = None
+        self.task = None
+
+    def datagram_received(self, data, addr):
+        self.pending.add(data.decode(errors="replace"))
+        self.changed.set()
+
+    async def _read(self, serials=None):
+        try:
+            wallboxes = await sync_to_async(read_wallboxes)(serials)
+        except DatabaseError as e:
+            logger.error("live_read_failed error=%s", e)
+            return {}
+        now = time.monotonic()
+        for serial in wallboxes:
+            self.read_at[serial] = now
+        return wallboxes
+
+    async def run(self):
+        if LIVE_UPDATES_PORT is not None:
+            try:
+                self.transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+                    lambda: self, local_addr=("127.0.0.1", LIVE_UPDATES_PORT))
+            except OSError as e:
+                # Clients still get the current state, but no changes
+                logger.error("live_updates_unavailable port=%s error=%s", LIVE_UPDATES_PORT, e)
+        self.state = await self._read()
+        self.ready.set()
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            serials, self.pending = self.pending, set()
+            for serial, wallbox in (await self._read(serials)).items():
+                previous = self.state.get(serial, {})
+                self.state[serial] = wallbox
+                delta = {name: value for name, value in wallbox.items()
+                         if name not in VOLATILE_FIELDS and previous.get(name) != value}
+                if delta:
+                    delta.update(serial=serial, uptime=wallbox['uptime'])
+                    self.publish(event("update", delta))
+
+    def publish(self, message):
+        live_events.inc()
+        for queue in list(self.clients):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Tell the client to reconnect instead of sending it stale changes
+                self.clients.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def snapshot(self):
+        now = time.monotonic()
+        return [dict(wallbox, uptime=wallbox['uptime'] + int(now - self.read_at[serial]))
+                for serial, wallbox in self.state.items()]
+
+    async def subscribe(self):
+        queue = asyncio.Queue(CLIENT_QUEUE_SIZE)
+        self.clients.add(queue)
+        live_clients.set(len(self.clients))
+        if self.task is None:
+            # Outlives the request of the first client, so it must not inherit its context (the thread sensitive
+            # context of its sync_to_async calls, its query count)
+            self.task = asyncio.create_task(self.run(), context=contextvars.Context())
+        await self.ready.wait()
+        return queue
+
+    def unsubscribe(self, queue):
+        self.clients.discard(queue)
+        live_clients.set(len(self.clients))
+        if not self.clients and self.task is not None:
+            self.task.cancel()
+            self.task = None
+            if self.transport is not None:
+                self.transport.close()
+                self.transport = None
+            self.state = {}
+            self.read_at = {}
+            self.pending = set()
+            self.ready.clear()
+
+
+BROADCASTER = WallboxBroadcaster()
+
+
+async def wallbox_events():
+    """
+    The live stream of a client: the state of all wallboxes, followed by their changes.
+    """
+    queue = await BROADCASTER.subscribe()
+    try:
+        yield f"retry: {RECONNECT_DELAY}\n\n"
+        yield event("snapshot", BROADCASTER.snapshot())
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if message is None:
+                return
+            yield message
+    finally:
+        BROADCASTER.unsubscribe(queue)
@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import setup_test_environment, teardown_test_environment
+from knox.models import AuthToken
+
+from api import views
+from api.management.commands.sessionQueryBenchmark import Command as SessionQueryBenchmark
+from api.management.commands.wallboxBenchmark import percentile
+from backend.settings import API_DB_CONCURRENCY
+
+# How often the number of threads is sampled (seconds)
+THREAD_SAMPLE_INTERVAL = 0.005
+
+
+async def asgi_get(application, url, headers):
+    """
+    Sends a GET request straight to the ASGI application, returns the status, headers and size of the response.
+    """
+    path, _, query = url.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": [(b"host", b"testserver")] + [(name.lower().encode(), value.encode()) for name, value in headers],
+        "client": ("127.0.0.1", 0), "server": ("testserver", 80),
+    }
+    request = [{"type": "http.request", "body": b"", "more_body": False}]
+    finished = asyncio.Event()
+    response = {"size": 0}
+
+    async def receive():
+        if request:
+            return request.pop()
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {name.decode().lower(): value.decode() for name, value in message["headers"]}
+        elif message["type"] == "http.response.body":
+            response["size"] += len(message.get("body", b""))
+            if not message.get("more_body"):
+                finished.set()
+
+    await application(scope, receive, send)
+    return response["status"], response["headers"], response["size"]
+
+
+class QueryConcurrency:
+    """
+    Tracks the queries running at once, in all threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def connection_created(self, connection, **kwargs):
+        connection.execute_wrappers.append(self.count_query)
+
+    def count_query(self, execute, sql, params, many, context):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class Command(BaseCommand):
+    help = "Load the list endpoints with concurrent clients through the ASGI application (as daphne would), once " \
+           "without a limit on the requests querying at once and once limited to API_DB_CONCURRENCY, and report " \
+           "throughput, latencies, the threads in use and the queries running at once. Runs against a throwaway " \
+           "database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sessions", type=int, default=10000, help="Number of charge sessions")
+        parser.add_argument("--tokens", type=int, default=50, help="Number of RFID tokens")
+        parser.add_argument("--wallboxes", type=int, default=20, help="Number of wallboxes")
+        parser.add_argument("--clients", type=int, default=100, help="Concurrent clients")
+        parser.add_argument("--requests", type=int, default=20, help="Requests per client and scenario")
+
+    def handle(self, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        setup_test_environment()
+        try:
+            SessionQueryBenchmark(stdout=self.stdout._out).populate(options)
+            token = AuthToken.objects.create(User.objects.create_user("loadtest"))[1]
+            application = get_asgi_application()
+            self.queries = QueryConcurrency()
+            connection_created.connect(self.queries.connection_created)
+            self.stdout.write(f"engine={connection.vendor} clients={options['clients']} "
+                              f"requests={options['requests']}")
+            slots = views.db_slots
+            try:
+                for mode, limit in (("unlimited", options["clients"]), ("limited", API_DB_CONCURRENCY)):
+                    views.db_slots = threading.BoundedSemaphore(limit)
+                    asyncio.run(self.run_scenarios(application, mode, token, options))
+            finally:
+                views.db_slots = slots
+        finally:
+            teardown_test_environment()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    async def run_scenarios(self, application, mode, token, options):
+        auth = [("Authorization", f"Token {token}")]
+        status, headers, size = await asgi_get(application, "/api/wallboxes/list/", auth)
+        # Dashboards polling the status (with and without revalidation) and the charge log (cached after the first
+        # request)
+        scenarios = [
+            ("wallboxes", "/api/wallboxes/list/", auth),
+            ("wallboxes_revalidate", "/api/wallboxes/list/", auth + [("If-None-Match", headers["etag"])]),
+            ("sessions_page", "/api/charge_sessions/list/?page_size=100", auth),
+            ("tokens", "/api/tokens/list/", auth),
+        ]
+        for name, url, headers in scenarios:
+            await self.run_scenario(application, mode, name, url, headers, options)
+
+    async def run_scenario(self, application, mode, name, url, headers, options):
+        latencies = []
+        statuses = set()
+        peak_threads = threading.active_count()
+        self.queries.peak = 0
+        done = asyncio.Event()
+
+        async def sample_threads():
+            nonlocal peak_threads
+            while not done.is_set():
+                peak_threads = max(peak_threads, threading.active_count())
+                await asyncio.sleep(THREAD_SAMPLE_INTERVAL)
+
+        async def client():
+            for i in range(options["requests"]):
+                start = time.perf_counter()
+                status, response_headers, size = await asgi_get(application, url, headers)
+                latencies.append(time.perf_counter() - start)
+                statuses.add(status)
+
+        sampler = asyncio.create_task(sample_threads())
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for i in range(options["clients"])))
+        duration = time.perf_counter() - start
+        done.set()
+        await sampler
+        latencies.sort()
+        self.stdout.write(f"mode={mode} scenario={name} status={','.join(map(str, sorted(statuses)))} "
+                          f"throughput={len(latencies) / duration:.0f}/s "
+                          f"latency p50={percentile(latencies, 50) * 1000:.1f}ms "
+                          f"p95={percentile(latencies, 95) * 1000:.1f}ms peak_threads={peak_threads} "
+                          f"peak_queries={self.queries.peak}")
@@ -0,0 +1,15 @@
+import time
+
+from django.core.management import BaseCommand
+
+from api.energy import rebuild_energy_rollups
+
+
+class Command(BaseCommand):
+    help = "Recompute the energy rollups of the aggregation API from all recorded charge sessions " \
+           "(e.g. after sessions were edited or deleted)"
+
+    def handle(self, **options):
+        start = time.monotonic()
+        count = rebuild_energy_rollups()
+        return f"Rebuilt {count} energy rollups in {time.monotonic() - start:.1f}s."
@@ -0,0 +1,117 @@
+import datetime
+import random
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from rest_framework.test import APIClient
+
+from api.cache import bump_data_generation, SESSIONS
+from api.management.commands.wallboxBenchmark import percentile
+from api.models import ChargeSession, RFIDToken, Wallbox
+
+BATCH_SIZE = 10000
+# One session every few hours per wallbox
+MEAN_SESSION_INTERVAL = datetime.timedelta(hours=6)
+
+
+class Command(BaseCommand):
+    help = "Fill a throwaway database with a synthetic charge session history and report the query plans and " \
+           "latencies of the session list. Uses the configured database engine (e.g. DB=postgres)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sessions", type=int, default=2000000, help="Number of charge sessions")
+        parser.add_argument("--tokens", type=int, default=50, help="Number of RFID tokens")
+        parser.add_argument("--wallboxes", type=int, default=20, help="Number of wallboxes")
+        parser.add_argument("--repeat", type=int, default=20, help="Requests per scenario")
+
+    def handle(self, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        setup_test_environment()
+        try:
+            first, last = self.populate(options)
+            middle = first + (last - first) / 2
+            month = {"not_before": middle.date().isoformat(), "not_after": (middle + datetime.timedelta(days=30)).date()}
+            token = RFIDToken.objects.order_by('pk').values_list('pk', flat=True).first()
+            wallbox = Wallbox.objects.order_by('pk').values_list('pk', flat=True).first()
+            scenarios = [
+                ("first_page", {"page_size": 100}),
+                ("first_page_by_start", {"page_size": 100, "ordering": "-started"}),
+                ("month", month),
+                ("month_token", dict(month, tokens=token)),
+                ("month_wallbox", dict(month, wallboxes=wallbox)),
+                ("first_page_token", {"page_size": 100, "tokens": token}),
+                ("first_page_token_by_start", {"page_size": 100, "tokens": token, "ordering": "-started"}),
+                ("first_page_wallbox_by_start", {"page_size": 100, "wallboxes": wallbox, "ordering": "-started"}),
+            ]
+            client = APIClient()
+            client.force_authenticate(User.objects.create_user("benchmark"))
+            self.stdout.write(f"engine={connection.vendor} sessions={options['sessions']} "
+                              f"tokens={options['tokens']} wallboxes={options['wallboxes']}")
+            for name, params in scenarios:
+                self.run_scenario(client, name, params, options["repeat"])
+        finally:
+            teardown_test_environment()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def populate(self, options):
+        start = time.monotonic()
+        tokens = RFIDToken.objects.bulk_create(
+            [RFIDToken(tokenID=f"{i:016x}", tokenClass="01010400000000000000", name=f"Token {i}")
+             for i in range(options["tokens"])])
+        wallboxes = Wallbox.objects.bulk_create([Wallbox(serial=f"{90000000 + i}")
+                                                 for i in range(options["wallboxes"])])
+        count = options["sessions"]
+        last = datetime.datetime.now(tz=datetime.timezone.utc)
+        first = last - MEAN_SESSION_INTERVAL * (count / len(wallboxes))
+        step = (last - first) / count
+        random.seed(0)
+        for offset in range(0, count, BATCH_SIZE):
+            sessions = []
+            for session_id in range(offset, min(offset + BATCH_SIZE, count)):
+                started = first + step * session_id + datetime.timedelta(seconds=random.randint(0, 600))
+                energy = Decimal(random.randint(1000, 600000)) / 10
+                sessions.append(ChargeSession(sessionID=session_id + 1, hardwareCurrentLimit=16000,
+                                              energyMeterAtStart=Decimal(session_id), chargedEnergy=energy,
+                                              started=started, ended=started + datetime.timedelta(hours=2),
+                                              token=random.choice(tokens), wallboxSerial=random.choice(wallboxes)))
+            ChargeSession.objects.bulk_create(sessions)
+        with connection.cursor() as cursor:
+            # Let the query planner know about the data
+            cursor.execute("ANALYZE")
+        self.stdout.write(f"populated sessions={count} duration={time.monotonic() - start:.1f}s")
+        return first, last
+
+    def run_scenario(self, client, name, params, repeat):
+        latencies = []
+        cached_latencies = []
+        for i in range(repeat):
+            # Invalidates the response cache
+            bump_data_generation(SESSIONS)
+            start = time.perf_counter()
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get("/api/charge_sessions/list/", params)
+                # The response is rendered lazily
+                response.content
+            latencies.append(time.perf_counter() - start)
+            # The log of the connection is reset by the next request
+            queries = queries.captured_queries
+            start = time.perf_counter()
+            client.get("/api/charge_sessions/list/", params).content
+            cached_latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        cached_latencies.sort()
+        self.stdout.write(f"scenario={name} status={response.status_code} queries={len(queries)} "
+                          f"bytes={len(response.content)} latency p50={percentile(latencies, 50) * 1000:.1f}ms "
+                          f"p95={percentile(latencies, 95) * 1000:.1f}ms "
+                          f"cached p50={percentile(cached_latencies, 50) * 1000:.1f}ms "
+                          f"p95={percentile(cached_latencies, 95) * 1000:.1f}ms")
+        for query in queries:
+            self.stdout.write(f"  query {query['sql']}")
+            with connection.cursor() as cursor:
+                cursor.execute(connection.ops.explain_query_prefix() + " " + query['sql'])
+                for row in cursor.fetchall():
+                    self.stdout.write("    plan " + " ".join(str(column) for column in row))
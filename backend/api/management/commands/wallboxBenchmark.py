@@ -0,0 +1,136 @@
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+
+import asyncudp
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from api.management.commands import wallboxIO
+from api.models import ChargeSession, PowerSample
+from api import simulator
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+
+
+class Statistics:
+    def __init__(self):
+        self.request_latencies = []
+        self.poll_durations = []
+        self.failed_requests = 0
+        self.queries = 0
+        self.writes = 0
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        if sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+            self.writes += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def benchmark_communicator(stats):
+    class BenchmarkCommunicator(wallboxIO.WallboxCommunicator):
+        async def _send(self, message):
+            start = time.monotonic()
+            try:
+                return await super()._send(message)
+            except wallboxIO.WallboxUnreachable:
+                stats.failed_requests += 1
+                raise
+            finally:
+                stats.request_latencies.append(time.monotonic() - start)
+
+        async def poll(self, reports):
+            start = time.monotonic()
+            await super().poll(reports)
+            stats.poll_durations.append(time.monotonic() - start)
+
+    return BenchmarkCommunicator
+
+
+class Command(BaseCommand):
+    help = "Run wallboxIO against simulated wallboxes on a throwaway database and report its throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=10, help="Number of simulated wallboxes")
+        parser.add_argument("--duration", type=float, default=60, help="Benchmark duration in seconds")
+        parser.add_argument("--base-address", default="127.0.1.1", help="Address of the first simulated wallbox")
+        parser.add_argument("--latency", type=float, default=0.01, help="Mean simulated response latency in seconds")
+        parser.add_argument("--loss", type=float, default=0.0, help="Probability of dropping a datagram")
+        parser.add_argument("--duplicates", type=float, default=0.0, help="Probability of sending a datagram twice")
+        parser.add_argument("--session-length", type=float, default=30, help="Mean charge session length in seconds")
+        parser.add_argument("--idle-length", type=float, default=10, help="Mean time between sessions in seconds")
+        parser.add_argument("--push-interval", type=float, default=5,
+                            help="Seconds between E pres pushes while charging")
+
+    def handle(self, **options):
+        # The simulator runs in its own process, so it doesn't compete with wallboxIO for the event loop
+        command = [sys.executable, str(settings.BASE_DIR / "manage.py"), "wallboxSimulator",
+                   "--count", str(options["count"]), "--base-address", options["base_address"],
+                   "--latency", str(options["latency"]), "--loss", str(options["loss"]),
+                   "--duplicates", str(options["duplicates"]), "--session-length", str(options["session_length"]),
+                   "--idle-length", str(options["idle_length"]), "--push-interval", str(options["push_interval"])]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        try:
+            ready = process.stdout.readline()
+            if not ready.startswith("Simulating"):
+                raise CommandError("Simulator failed to start")
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                stats = Statistics()
+                wallbox_ips = simulator.addresses(options["base_address"], options["count"])
+                asyncio.run(self.benchmark(wallbox_ips, options["duration"], stats))
+                self.report(stats, options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        finally:
+            process.terminate()
+            process.wait()
+
+    async def benchmark(self, wallbox_ips, duration, stats):
+        # Database work happens in the sync_to_async and the writer thread, count queries on their connections
+        writer = wallboxIO.DatabaseWriter()
+        await sync_to_async(lambda: connection.execute_wrappers.append(stats.count_query))()
+        await writer._run_sync(lambda: connection.execute_wrappers.append(stats.count_query))
+        sock = await asyncudp.create_socket(local_addr=("127.0.0.1", wallboxIO.WALLBOX_PORT))
+        try:
+            await asyncio.wait_for(wallboxIO.serve(sock, wallbox_ips, communicator_class=benchmark_communicator(stats),
+                                                   healthcheck_url=None, writer=writer), timeout=duration)
+        except TimeoutError:
+            pass
+        finally:
+            sock.close()
+        stats.sessions = await ChargeSession.objects.acount()
+        stats.samples = await PowerSample.objects.acount()
+        await sync_to_async(lambda: connection.execute_wrappers.remove(stats.count_query))()
+        await writer._run_sync(lambda: connection.execute_wrappers.remove(stats.count_query))
+        stats.dropped = sum(wallboxIO.ingest_dropped.values.values())
+
+    def report(self, stats, options):
+        duration = options["duration"]
+        latencies = sorted(stats.request_latencies)
+        polls = sorted(stats.poll_durations)
+        retransmits = sum(wallboxIO.retransmits.values.values())
+        self.stdout.write(f"wallboxes={options['count']} duration={duration:g}s")
+        self.stdout.write(f"requests={len(latencies)} requests_per_second={len(latencies) / duration:.1f} "
+                          f"failed={stats.failed_requests} retransmits={retransmits:g}")
+        self.stdout.write(f"request_latency p50={percentile(latencies, 50) * 1000:.1f}ms "
+                          f"p95={percentile(latencies, 95) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms")
+        self.stdout.write(f"polls={len(polls)} polls_per_second={len(polls) / duration:.1f} "
+                          f"poll_duration p50={percentile(polls, 50) * 1000:.1f}ms "
+                          f"p95={percentile(polls, 95) * 1000:.1f}ms p99={percentile(polls, 99) * 1000:.1f}ms")
+        self.stdout.write(f"queries={stats.queries} writes={stats.writes} "
+                          f"writes_per_second={stats.writes / duration:.1f} dropped={stats.dropped:g}")
+        self.stdout.write(f"sessions={stats.sessions} power_samples={stats.samples}")
@@ -1,101 +1,147 @@
 import asyncio
 import datetime
 import functools
-import json
+import http.client
+import logging
 import os
+import random
 import signal
+import socket
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
-from urllib.error import URLError
-import urllib.request
+from urllib.parse import urlsplit
 
 import asyncudp
+from asgiref.sync import sync_to_async
 from django.core.management import BaseCommand
-
-from api.models import Wallbox, ChargeSession, RFIDToken, WALLBOX_TIME_NTP, SERVER_TIME, SESSION_CABLE_UNPLUGGED, \
+from django.db import transaction, DatabaseError, DataError
+
+from api.cache import LRUCache, identity_generation
+from api.capture import CaptureWriter, read_capture
+from api.energy import add_to_energy_rollup, remove_from_energy_rollup
+from api.reports import decode, InvalidReport, Push
+from api.metrics import REGISTRY
+from api.models import Wallbox, ChargeSession, RFIDToken, PowerSample, WALLBOX_TIME_NTP, SERVER_TIME, SESSION_CABLE_UNPLUGGED, \
     SESSION_CARD_DEAUTH, TIME_UNKNOWN, SESSION_RUNNING, SESSION_STATUS_UNKNOWN
-from backend.settings import WALLBOX_IP, HEALTHCHECK_URL
+from api.telemetry import maintain_telemetry
+from backend.settings import WALLBOX_IPS, HEALTHCHECK_URL, HEALTHCHECK_INTERVAL, HEALTHCHECK_TIMEOUT, \
+    DATAGRAM_BUFFER_SIZE, METRICS, METRICS_FILE, CAPTURE_FILE, INGEST_QUEUE_SIZE, LIVE_UPDATES_PORT, WALLBOX_LOCAL_IP, \
+    WALLBOX_LOCAL_PORT
+
+logger = logging.getLogger(__name__)
 
 WALLBOX_PORT = 7090
-DESTINATION = (WALLBOX_IP, WALLBOX_PORT)
-LOCAL_IP = "0.0.0.0"
 # Note: It is important that the local socket is bound to the wallbox port - the wallbox is unable to respond otherwise.
-SOURCE = (LOCAL_IP, WALLBOX_PORT)
+SOURCE = (WALLBOX_LOCAL_IP, WALLBOX_LOCAL_PORT)
 
 PROBE_INTERVAL = 3600
 PROBE_INTERVAL_RUNNING = 60
+CHARGING_STATUS_INTERVAL_RUNNING = 10
 MIN_WAIT = 0.1
 RESPONSE_TIMEOUT = 5
+# Requests are sent this many times before the wallbox is considered unreachable
+RESPONSE_ATTEMPTS = 3
+# Exponential backoff (seconds) for polling unreachable wallboxes
+BACKOFF_BASE = 10
+BACKOFF_MAX = 900
+# Polls are randomly moved by up to this fraction of their interval, to spread the traffic of a fleet
+SCHEDULE_JITTER = 0.1
+# Reports that are due within this many seconds are polled together
+SCHEDULE_COALESCE = 5
+# The first polls of a fleet are spread over this many seconds
+STARTUP_SPREAD = 10
+# Unchanged status reports are not written, but refresh lastUpdated at least this often (seconds)
+LAST_UPDATED_MAX_AGE = 900
+# Deviation (seconds) between reported and extrapolated uptime that is considered a change (i.e. a reboot)
+UPTIME_TOLERANCE = 5
+IDENTITY_CACHE_SIZE = 256
+TELEMETRY_MAINTENANCE_INTERVAL = 60
+METRICS_WRITE_INTERVAL = 15
+# Seconds to wait before retrying to write charge sessions after a database error
+WRITE_RETRY_DELAY = 5
+# Errors of records that can't be persisted (impossible times, values out of range), retrying doesn't help
+MALFORMED_RECORD_ERRORS = (ValueError, TypeError, ArithmeticError, DataError)
 
 BUILDUP = b'i'
 SYSTEM_STATUS = b'report 1'
 CONFIGURATION_STATUS = b'report 2'
 CHARGING_STATUS = b'report 3'
 CURRENT_SESSION_STATUS = b'report 100'
-
-schedule_probe = True
-last_state = None
-
-
-def validate_json(string, message_id=None):
-    try:
-        parsed = json.loads(string)
-        if message_id is not None:
-            return parsed['ID'] == str(message_id)
-    except (ValueError, KeyError, TypeError, IndexError):
-        return False
-
-
-def validate_anything(message):
-    return True
-
-
-def validate_system_status(message):
-    return validate_json(message, 1)
-
-
-def validate_config_status(message):
-    return validate_json(message, 2)
-
-
-def validate_charging_status(message):
-    return validate_json(message, 3)
-
-
-def validate_current_charge_session(message):
-    return validate_json(message, 100)
-
-
-def validate_progress_report(message):
-    try:
-        parsed = json.loads(message)
-        keys = parsed.keys()
-        if len(keys) != 1:
-            return False
-        if next(iter(keys)) in ["E pres", "Max curr", "Enable sys", "Input", "Plug", "State"]:
-            return True
-    except (ValueError, KeyError, TypeError, IndexError):
-        return False
-
-
-def validate_history_report(report_id, message):
-    return validate_json(message, report_id)
+# Polling interval (seconds) of every report, while idle and while charging
+REPORT_INTERVALS = {
+    SYSTEM_STATUS: (PROBE_INTERVAL, PROBE_INTERVAL),
+    CONFIGURATION_STATUS: (PROBE_INTERVAL, PROBE_INTERVAL_RUNNING * 10),
+    CHARGING_STATUS: (PROBE_INTERVAL, CHARGING_STATUS_INTERVAL_RUNNING),
+    CURRENT_SESSION_STATUS: (PROBE_INTERVAL, PROBE_INTERVAL_RUNNING),
+}
+# Reports to poll right away when the wallbox pushes a change of the given value
+PUSH_REPORTS = {
+    "E pres": [],
+    "Plug": [CURRENT_SESSION_STATUS],
+    "State": [CHARGING_STATUS, CURRENT_SESSION_STATUS],
+    "Max curr": [CHARGING_STATUS],
+    "Enable sys": [CHARGING_STATUS],
+    "Input": [],
+}
+# The wallbox keeps its last 30 sessions in reports 101 (newest) to 130 (oldest)
+HISTORY_FIRST_REPORT = 101
+HISTORY_SIZE = 30
+
+# Serials and RFID tags rarely change, so cache the rows they resolve to
+wallbox_identities = LRUCache(IDENTITY_CACHE_SIZE)
+token_identities = LRUCache(IDENTITY_CACHE_SIZE)
+seen_identity_generation = None
+
+report_latency = REGISTRY.histogram("wallbox_report_latency_seconds",
+                                    "Time from the first transmission of a request to its reply")
+retransmits = REGISTRY.counter("wallbox_retransmits_total", "Requests sent again after a response timeout")
+rejections = REGISTRY.counter("wallbox_validation_rejections_total", "Received messages that failed validation")
+pushes_received = REGISTRY.counter("wallbox_pushes_total", "Push messages received, by type")
+db_write_latency = REGISTRY.histogram("wallbox_db_write_seconds", "Time spent persisting data, by operation")
+ingest_queue_depth = REGISTRY.gauge("wallbox_ingest_queue_depth", "Reports, pushes and sessions waiting to be written")
+ingest_lag = REGISTRY.histogram("wallbox_ingest_lag_seconds", "Time from receiving data to writing it to the database")
+ingest_dropped = REGISTRY.counter("wallbox_ingest_dropped_total",
+                                  "Reports and pushes dropped because the database fell behind")
+identity_cache = REGISTRY.counter("wallbox_identity_cache_total",
+                                  "Lookups in the wallbox and token caches, by cache and result")
+malformed_dropped = REGISTRY.counter("wallbox_malformed_records_total",
+                                     "Reports, pushes and sessions dropped because they could not be persisted")
+history_scan_length = REGISTRY.histogram("wallbox_history_scan_entries", "History entries fetched per scan",
+                                         buckets=(0, 1, 2, 5, 10, 20, 30))
+
+
+def history_request(position):
+    return ("report " + str(HISTORY_FIRST_REPORT + position)).encode("utf-8")
+
+
+def fixed_point(value, digits):
+    # Reports carry integers in fixed units (e.g. 0.1 Wh), the database stores decimals
+    return Decimal(value).scaleb(-digits)
+
+
+def session_finished(entry):
+    # Running sessions have been observed to use undocumented reason IDs, so check the end time as well
+    return entry.reason in [1, 10] or entry.ended_seconds != 0
 
 
 def parse_datetime(timestring_start, timestring_end):
-    format = "%Y-%m-%d %H:%M:%S.%f"
-    start = datetime.datetime.strptime(timestring_start, format)
-    start = start.replace(tzinfo=datetime.timezone.utc)
+    # The wallbox uses "%Y-%m-%d %H:%M:%S.%f", which fromisoformat parses much faster than strptime
+    start = datetime.datetime.fromisoformat(timestring_start).replace(tzinfo=datetime.timezone.utc)
     # End time may not be set for live sessions
     if timestring_end != "0":
-        end = datetime.datetime.strptime(timestring_end, format)
-        end = end.replace(tzinfo=datetime.timezone.utc)
+        end = datetime.datetime.fromisoformat(timestring_end).replace(tzinfo=datetime.timezone.utc)
     else:
         end = None
     return start, end
 
 
-def parse_weak_timestamps(start_seconds, end_seconds, current_seconds):
+def receive_time(received):
+    return datetime.datetime.fromtimestamp(received, tz=datetime.timezone.utc)
+
+
+def parse_weak_timestamps(start_seconds, end_seconds, current_seconds, received):
     # Note: There is an undocumented feature here: "Sometimes", the wallbox puts a Unix timestamp
     # into these fields, instead of a relative time. We can detect this by looking for impossible values.
     if start_seconds > (current_seconds + 1):
@@ -107,11 +153,11 @@ def parse_weak_timestamps(start_seconds, end_seconds, current_seconds):
         else:
             end = datetime.datetime.fromtimestamp(end_seconds, tz=datetime.timezone.utc)
     else:
-        # current_offset is the wallbox current time in seconds since boot. Assuming that
-        # we've received the data packet just now, this offset is more or less exactly
-        # the current time (+ network/processing delays). We can then use this anchor in time
+        # current_offset is the wallbox current time in seconds since boot. As the wallbox sent
+        # the data packet right before we received it, this offset is more or less exactly
+        # the receive time (+ network delays). We can then use this anchor in time
         # to compute the start and end time
-        now = datetime.datetime.now(tz=datetime.timezone.utc).replace(microsecond=0)
+        now = receive_time(received).replace(microsecond=0)
         start_offset = current_seconds - start_seconds
         end_offset = current_seconds - end_seconds
         start = now - datetime.timedelta(seconds=start_offset)
@@ -122,68 +168,121 @@ def parse_weak_timestamps(start_seconds, end_seconds, current_seconds):
     return start, end
 
 
-async def parse_charge_session(raw_data):
-    if int(raw_data['Session ID']) < 1:
+def parse_charge_session(report, received):
+    # Note: Does not resolve the wallbox and token of the session, callers need to do this.
+    if report.session_id < 1:
         return None
-    session = ChargeSession(pk=int(raw_data['Session ID']))
-    session.hardwareCurrentLimit = int(raw_data['Curr HW'])
-    session.energyMeterAtStart = Decimal(raw_data['E start']) / Decimal(10)
-    session.chargedEnergy = Decimal(raw_data['E pres']) / Decimal(10)
-    timesource = ChargeSession.time_status_from_raw(raw_data['timeQ'])
+    session = ChargeSession(sessionID=report.session_id)
+    session.hardwareCurrentLimit = report.hardware_limit
+    session.energyMeterAtStart = fixed_point(report.energy_start, 1)
+    session.chargedEnergy = fixed_point(report.energy_present, 1)
+    timesource = ChargeSession.time_status_from_raw(report.time_q)
     if timesource == WALLBOX_TIME_NTP:
-        started, ended = parse_datetime(raw_data['started'], raw_data['ended'])
+        started, ended = parse_datetime(report.started, report.ended)
     else:  # For any other time source, use local time
-        started, ended = parse_weak_timestamps(int(raw_data['started[s]']), int(raw_data['ended[s]']),
-                                               int(raw_data['Sec']))
+        started, ended = parse_weak_timestamps(report.started_seconds, report.ended_seconds, report.sec, received)
         timesource = SERVER_TIME
     session.timesource = timesource
     session.started = started
     session.ended = ended
-    session.stopReason = ChargeSession.reason_from_raw(int(raw_data['reason']))
-    session.wallboxSerial = await Wallbox.get_instance(raw_data['Serial'])
-    session.token = await RFIDToken.get_instance(raw_data['RFID tag'], raw_data['RFID class'])
+    session.stopReason = ChargeSession.reason_from_raw(report.reason)
     return session
 
 
-async def add_charge_session(raw_data):
-    session = await parse_charge_session(raw_data)
-    await session.asave()
-
-
-async def update_from_report(report):
-    serial = report['Serial']
-    wallbox = await Wallbox.get_instance(serial)
-    if report['ID'] == str(1):
-        wallbox.product = report['Product']
-        wallbox.serial = report['Serial']
-        wallbox.firmwareVersion = report['Firmware']
-        wallbox.timeStatus = Wallbox.time_status_from_raw(int(report['timeQ']))
-        wallbox.uptime = datetime.timedelta(seconds=report['Sec'])
-    if report['ID'] == str(2):
-        wallbox.state = Wallbox.state_from_raw(int(report['State']))
-        wallbox.plug = Wallbox.plug_from_raw(int(report['Plug']))
-        wallbox.uptime = datetime.timedelta(seconds=report['Sec'])
-    if report['ID'] == str(3):
-        wallbox.currentChargePower = Decimal(report['P']) / Decimal(1000)
-        wallbox.currentPowerFactor = Decimal(report['PF']) / Decimal(10)
-        wallbox.currentSession = Decimal(report['E pres']) / Decimal(10)
-        wallbox.energyMeter = Decimal(report['E total']) / Decimal(10)
-        wallbox.phase1_voltage = Decimal(report['U1'])
-        wallbox.phase2_voltage = Decimal(report['U2'])
-        wallbox.phase3_voltage = Decimal(report['U3'])
-        wallbox.phase1_current = Decimal(report['I1']) / Decimal(1000)
-        wallbox.phase2_current = Decimal(report['I2']) / Decimal(1000)
-        wallbox.phase3_current = Decimal(report['I3']) / Decimal(1000)
-        wallbox.uptime = datetime.timedelta(seconds=report['Sec'])
-    if report['ID'] == str(100):
-        session = await parse_charge_session(report)
+def refresh_identity_caches():
+    global seen_identity_generation
+    generation = identity_generation()
+    if generation != seen_identity_generation:
+        # A token or wallbox was edited or deleted in the admin
+        wallbox_identities.clear()
+        token_identities.clear()
+        seen_identity_generation = generation
+
+
+def get_wallbox_sync(serial):
+    wallbox = wallbox_identities.get(serial)
+    identity_cache.inc(cache="wallbox", result="miss" if wallbox is None else "hit")
+    if wallbox is None:
+        (wallbox, created) = Wallbox.objects.get_or_create(serial=serial)
+        wallbox_identities.put(serial, wallbox)
+    return wallbox
+
+
+def get_token_sync(tag, t_class):
+    token = token_identities.get((tag, t_class))
+    identity_cache.inc(cache="token", result="miss" if token is None else "hit")
+    if token is None:
+        (token, created) = RFIDToken.objects.get_or_create(tokenID=tag, tokenClass=t_class)
+        token_identities.put((tag, t_class), token)
+    return token
+
+
+def add_charge_session(report, received):
+    session = parse_charge_session(report, received)
+    if session is None:
+        return
+    session.wallboxSerial = get_wallbox_sync(report.serial)
+    session.token = get_token_sync(report.rfid_tag, report.rfid_class)
+    with transaction.atomic():
+        # Sessions recorded before (e.g. when replaying a capture) must not be counted twice
+        previous = ChargeSession.objects.select_for_update() \
+            .filter(wallboxSerial=session.wallboxSerial, sessionID=session.sessionID) \
+            .only('pk', 'started', 'token', 'wallboxSerial', 'chargedEnergy').first()
+        if previous is None:
+            session.save()
+            add_to_energy_rollup(session)
+        else:
+            session.pk = previous.pk
+            session.save(update_fields=[field.name for field in ChargeSession._meta.concrete_fields
+                                        if field.name not in ('id', 'created')])
+            if (previous.started, previous.token_id, previous.chargedEnergy) != \
+                    (session.started, session.token_id, session.chargedEnergy):
+                # Count the session with its new data
+                remove_from_energy_rollup(previous)
+                add_to_energy_rollup(session)
+
+
+def apply_report(wallbox, report, received):
+    if isinstance(report, Push):
+        if report.name == "E pres":
+            wallbox.currentSession = fixed_point(report.value, 1)
+        elif report.name == "State":
+            wallbox.state = Wallbox.state_from_raw(report.value)
+        elif report.name == "Plug":
+            wallbox.plug = Wallbox.plug_from_raw(report.value)
+        # Other pushes are not stored
+        return
+    if report.report_id == 1:
+        wallbox.product = report.product
+        wallbox.serial = report.serial
+        wallbox.firmwareVersion = report.firmware
+        wallbox.timeStatus = Wallbox.time_status_from_raw(report.time_q)
+        wallbox.uptime = datetime.timedelta(seconds=report.sec)
+    if report.report_id == 2:
+        wallbox.state = Wallbox.state_from_raw(report.state)
+        wallbox.plug = Wallbox.plug_from_raw(report.plug)
+        wallbox.uptime = datetime.timedelta(seconds=report.sec)
+    if report.report_id == 3:
+        wallbox.currentChargePower = fixed_point(report.power, 3)
+        wallbox.currentPowerFactor = fixed_point(report.power_factor, 1)
+        wallbox.currentSession = fixed_point(report.energy_present, 1)
+        wallbox.energyMeter = fixed_point(report.energy_total, 1)
+        wallbox.phase1_voltage = Decimal(report.voltage1)
+        wallbox.phase2_voltage = Decimal(report.voltage2)
+        wallbox.phase3_voltage = Decimal(report.voltage3)
+        wallbox.phase1_current = fixed_point(report.current1, 3)
+        wallbox.phase2_current = fixed_point(report.current2, 3)
+        wallbox.phase3_current = fixed_point(report.current3, 3)
+        wallbox.uptime = datetime.timedelta(seconds=report.sec)
+    if report.report_id == 100:
+        session = parse_charge_session(report, received)
         if session is not None:
             wallbox.currentHardwareLimit = session.hardwareCurrentLimit
             wallbox.currentEnergyMeterAtStart = session.energyMeterAtStart
             wallbox.currentSession = session.chargedEnergy
             wallbox.currentStartTime = session.started
             # This is probably unnecessary since the parser will have already done this
-            if report["ended[s]"] > 0:
+            if report.ended_seconds > 0:
                 wallbox.currentEndTime = session.ended
             else:
                 wallbox.currentEndTime = None
@@ -191,148 +290,723 @@ async def update_from_report(report):
                 # Sometimes, the wallbox reports that the session has ended, but the stopReason is put to 0 for some reason
                 wallbox.currentSessionStatus = SESSION_STATUS_UNKNOWN
             wallbox.currentSessionStatus = session.stopReason
-            wallbox.currentToken = session.token
+            wallbox.currentToken = get_token_sync(report.rfid_tag, report.rfid_class)
             wallbox.currentSessionID = session.sessionID
 
-    await wallbox.asave()
+
+def power_sample(wallbox, report, received):
+    # Running sessions have no end time yet
+    session_id = wallbox.currentSessionID if wallbox.currentEndTime is None else None
+    return PowerSample(wallbox=wallbox, sessionID=session_id, timestamp=receive_time(received),
+                       power=report.power, powerFactor=report.power_factor, energy=report.energy_present,
+                       phase1_voltage=report.voltage1, phase2_voltage=report.voltage2,
+                       phase3_voltage=report.voltage3, phase1_current=report.current1,
+                       phase2_current=report.current2, phase3_current=report.current3)
+
+
+def replaceable(update):
+    # Superseded by the next charging report or energy push. State changes (and sessions) must not be dropped.
+    if isinstance(update, Push):
+        return update.name == "E pres"
+    return update.report_id == 3
+
+
+def wallbox_fields(wallbox):
+    return {field.name: getattr(wallbox, field.attname) for field in Wallbox._meta.concrete_fields}
+
+
+def persist_reports(wallbox, updates):
+    """
+    Merges status reports and pushes (in order) into the in-memory snapshot of a wallbox and writes only the columns
+    that changed, within a single transaction. Updates are (receive time, report or push) pairs, the receive time
+    anchors the relative timestamps of the wallbox. Pass None as snapshot to load it from the database, which requires
+    a report (pushes carry no serial). Returns the updated snapshot.
+    """
+    reports = [update for received, update in updates if not isinstance(update, Push)]
+    if wallbox is None and not reports:
+        return None
+    with transaction.atomic():
+        if wallbox is None or (reports and wallbox.serial != reports[0].serial):
+            (wallbox, created) = Wallbox.objects.select_related('currentToken').get_or_create(serial=reports[0].serial)
+        before = wallbox_fields(wallbox)
+        for received, update in updates:
+            apply_report(wallbox, update, received)
+        after = wallbox_fields(wallbox)
+        changed = [name for name, value in after.items() if value != before[name] and name not in ('uptime', 'lastUpdated')]
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        if not reports:
+            # Pushes carry no uptime. The API extrapolates the uptime from lastUpdated, so advance both together
+            # (lastUpdated also validates the cached responses of the API).
+            if changed:
+                wallbox.uptime = before['uptime'] + (now - wallbox.lastUpdated)
+                wallbox.save(update_fields=set(changed) | {'uptime', 'lastUpdated'})
+            return wallbox
+        # The API extrapolates the uptime from lastUpdated, so it only changes when the wallbox rebooted
+        expected_uptime = before['uptime'] + (now - wallbox.lastUpdated)
+        if abs((after['uptime'] - expected_uptime).total_seconds()) > UPTIME_TOLERANCE:
+            changed.append('uptime')
+        if changed or (now - wallbox.lastUpdated).total_seconds() >= LAST_UPDATED_MAX_AGE:
+            update_fields = set(changed) | {'uptime', 'lastUpdated'}
+            wallbox.save(update_fields=update_fields)
+        charging = [(received, update) for received, update in updates
+                    if not isinstance(update, Push) and update.report_id == 3]
+        if charging:
+            # Several charging reports only come together when writes fall behind, the latest one is good enough
+            received, report = charging[-1]
+            power_sample(wallbox, report, received).save()
+    return wallbox
+
+
+class DatabaseWriter:
+    """
+    Persists wallbox data in the background, so a slow database never holds up the communication with the wallboxes.
+    Reports and pushes pass through a bounded queue that drops the oldest charging reports and energy pushes when
+    full, and everything queued for a wallbox is coalesced into a single write. State changes are kept even beyond
+    the bound, charge sessions are never dropped, failed writes are retried.
+    """
+
+    def __init__(self, size=INGEST_QUEUE_SIZE):
+        # (enqueue time, wallbox address, receive time, report or push)
+        self.updates = deque()
+        self.size = size
+        # Charge sessions waiting to be written: (wallbox serial, session ID) -> (enqueue time, receive time, report)
+        self.sessions = {}
+        # In-memory snapshot of the Wallbox row, by wallbox address
+        self.snapshots = {}
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # A dedicated thread (and database connection), so slow writes don't hold up the reads of the communicators
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database-writer")
+        self.notifier = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.notifier.setblocking(False)
+
+    def notify(self, serial):
+        # Announces a changed wallbox to the live stream of the API (see api.live), fire and forget
+        if LIVE_UPDATES_PORT is None:
+            return
+        try:
+            self.notifier.sendto(serial.encode(), ("127.0.0.1", LIVE_UPDATES_PORT))
+        except OSError:
+            # Nobody listening or the buffer is full, the stream catches up with the next change
+            pass
+
+    def submit(self, address, update, received):
+        if len(self.updates) >= self.size:
+            # Newer telemetry supersedes the oldest
+            for index, entry in enumerate(self.updates):
+                if replaceable(entry[3]):
+                    del self.updates[index]
+                    ingest_dropped.inc()
+                    break
+        self.updates.append((time.monotonic(), address, received, update))
+        self._queued()
+
+    def submit_session(self, report, received):
+        self.sessions.setdefault((report.serial, report.session_id), (time.monotonic(), received, report))
+        self._queued()
+
+    def _queued(self):
+        ingest_queue_depth.set(len(self.updates) + len(self.sessions))
+        self.idle.clear()
+        self.wakeup.set()
+
+    async def _run_sync(self, function, *args):
+        return await sync_to_async(function, thread_sensitive=False, executor=self.executor)(*args)
+
+    async def _write_sessions(self):
+        for key, (queued, received, report) in list(self.sessions.items()):
+            start = time.monotonic()
+            try:
+                await self._run_sync(add_charge_session, report, received)
+            except MALFORMED_RECORD_ERRORS as e:
+                logger.error("malformed_session wallbox=%s session=%s error=%r action=drop", *key, e)
+                malformed_dropped.inc(kind="session")
+                del self.sessions[key]
+                continue
+            except DatabaseError as e:
+                logger.error("session_write_failed wallbox=%s session=%s error=%s action=retry", *key, e)
+                return False
+            del self.sessions[key]
+            now = time.monotonic()
+            db_write_latency.observe(now - start, operation="session")
+            ingest_lag.observe(now - queued, kind="session")
+        return True
+
+    async def _write_updates(self):
+        updates, self.updates = self.updates, deque()
+        by_wallbox = {}
+        for queued, address, received, update in updates:
+            by_wallbox.setdefault(address, []).append((queued, received, update))
+        for address, entries in by_wallbox.items():
+            # Drop the snapshot while persisting, so a failed write makes us reload it from the database next time
+            wallbox = self.snapshots.pop(address, None)
+            before = wallbox_fields(wallbox) if wallbox is not None else None
+            start = time.monotonic()
+            try:
+                wallbox = await self._run_sync(persist_reports, wallbox,
+                                               [(received, update) for queued, received, update in entries])
+            except MALFORMED_RECORD_ERRORS:
+                wallbox = await self._write_one_by_one(address, entries)
+            except DatabaseError as e:
+                logger.error("write_failed wallbox=%s updates=%s error=%s action=drop", address[0], len(entries), e)
+                continue
+            if wallbox is not None:
+                self.snapshots[address] = wallbox
+                after = wallbox_fields(wallbox)
+                if before is None or any(after[name] != before[name] for name in after if name != 'uptime'):
+                    self.notify(wallbox.serial)
+            now = time.monotonic()
+            db_write_latency.observe(now - start, operation="reports")
+            ingest_lag.observe(now - entries[0][0], kind="reports")
+
+    async def _write_one_by_one(self, address, entries):
+        # Some update can't be persisted, find it and write the others
+        wallbox = None
+        for queued, received, update in entries:
+            try:
+                wallbox = await self._run_sync(persist_reports, wallbox, [(received, update)])
+            except MALFORMED_RECORD_ERRORS as e:
+                logger.error("malformed_update wallbox=%s data=%s error=%r action=drop", address[0], update, e)
+                malformed_dropped.inc(kind="update")
+                # The snapshot may be half updated, reload it
+                wallbox = None
+            except DatabaseError as e:
+                logger.error("write_failed wallbox=%s updates=1 error=%s action=drop", address[0], e)
+                wallbox = None
+        return wallbox
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            # Drop the cached wallboxes and tokens edited in the admin, in the thread using them (reads the shared cache)
+            await self._run_sync(refresh_identity_caches)
+            if not await self._write_sessions():
+                await asyncio.sleep(WRITE_RETRY_DELAY)
+                self.wakeup.set()
+            await self._write_updates()
+            ingest_queue_depth.set(len(self.updates) + len(self.sessions))
+            if not self.updates and not self.sessions:
+                self.idle.set()
+
+
+class WallboxUnreachable(Exception):
+    pass
+
+
+class WallboxDispatcher:
+    """
+    Owns the UDP socket shared by all wallboxes and routes every received datagram to the communicator
+    responsible for its source address.
+    """
+
+    def __init__(self, socket, capture=None):
+        self.sock = socket
+        self.communicators = {}
+        # Recent raw datagrams (arrival time, source address, payload) for debugging, dumped on demand
+        self.recent = deque(maxlen=DATAGRAM_BUFFER_SIZE) if DATAGRAM_BUFFER_SIZE else None
+        self.capture = capture
+
+    def register(self, communicator):
+        self.communicators[communicator.destination] = communicator
+
+    async def run(self):
+        while True:
+            data, addr = await self.sock.recvfrom()
+            received = time.time()
+            if self.recent is not None:
+                self.recent.append((received, addr, data))
+            if self.capture is not None:
+                self.capture.write(received, addr, data)
+            communicator = self.communicators.get(addr)
+            if communicator is None:
+                logger.warning("unauthorized_packet address=%s:%s", *addr)
+                continue
+            communicator.datagram_received(data, received)
+
+    def dump_recent(self):
+        if self.recent is None:
+            logger.info("datagram_buffer disabled")
+            return
+        for timestamp, addr, data in list(self.recent):
+            logger.info("datagram time=%.3f address=%s:%s data=%s", timestamp, *addr, data.decode("utf-8", "replace"))
+
+
+def request_key(message):
+    # Replies to "report N" carry N as their ID, the reply to "i" has no ID at all
+    parts = message.split()
+    return parts[1].decode("utf-8") if len(parts) > 1 else message.decode("utf-8")
+
+
+def is_buildup_reply(data):
+    # The reply to "i" is a bare "Firmware":"..." pair, not a JSON object
+    return data.lstrip().startswith(b'"Firmware"')
 
 
 class WallboxCommunicator:
-    def __init__(self, socket):
+    def __init__(self, socket, destination, writer):
         self.last_state = None
+        self.last_session = None
+        # Time of the last successful poll
+        self.last_success = None
+        self.history_fingerprint = None
+        # Next poll (monotonic time) of every report
+        self.next_poll = {}
+        self.writer = writer
         self.sock = socket
-
-    async def _send(self, message, response_validator):
+        self.destination = destination
+        self.last_send = 0
+        self.send_lock = asyncio.Lock()
+        # Requests waiting for their reply, by report ID
+        self.pending = {}
+        # Receive time (unix seconds) of the latest reply, by report ID. Anchors the timestamps of the reply.
+        self.received = {}
+        # Unsolicited messages (push notifications) from our wallbox, with their receive time
+        self.pushes = asyncio.Queue()
+
+    def datagram_received(self, data, received):
+        # Every datagram is decoded exactly once, the resulting record is passed on from here
+        try:
+            report = decode(data)
+        except InvalidReport as e:
+            # Keep waiting for a valid reply, the request is sent again after a timeout
+            logger.warning("invalid_reply wallbox=%s request=%s data=%s", self.destination[0], e.report_id,
+                           data.decode("utf-8", "replace"))
+            rejections.inc(wallbox=self.destination[0], kind="reply")
+            return
+        if isinstance(report, Push) and report.name in PUSH_REPORTS:
+            self.pushes.put_nowait((received, report))
+            return
+        if report is not None and not isinstance(report, Push):
+            key = str(report.report_id)
+        elif report is None and is_buildup_reply(data):
+            key = request_key(BUILDUP)
+            report = data.decode("utf-8", "replace")
+        else:
+            logger.warning("invalid_push wallbox=%s data=%s action=probe", self.destination[0],
+                           data.decode("utf-8", "replace"))
+            rejections.inc(wallbox=self.destination[0], kind="push")
+            # Wake up the scheduler, so it probes the wallbox
+            self.pushes.put_nowait((received, None))
+            return
+        future = self.pending.pop(key, None)
+        if future is None or future.done():
+            logger.debug("late_reply wallbox=%s data=%s", self.destination[0], report)
+            return
+        self.received[key] = received
+        future.set_result(report)
+
+    async def _transmit(self, message):
+        async with self.send_lock:
+            # Ensure we limit sending speed
+            delay = self.last_send + MIN_WAIT - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.sock.sendto(message, self.destination)
+            self.last_send = time.monotonic()
+
+    async def _send(self, message):
+        key = request_key(message)
+        future = None
         resend = True
+        attempts = 0
+        start = time.monotonic()
         while True:
+            if future is None or future.done():
+                future = self.pending.get(key)
+                if future is None or future.done():
+                    future = asyncio.get_running_loop().create_future()
+                    self.pending[key] = future
             if resend:
-                # Ensure we limit sending speed
-                await asyncio.sleep(MIN_WAIT)
-                self.sock.sendto(message)
+                if attempts >= RESPONSE_ATTEMPTS:
+                    if self.pending.get(key) is future:
+                        del self.pending[key]
+                    raise WallboxUnreachable(f"Wallbox {self.destination} did not respond to {message}")
+                if attempts > 0:
+                    retransmits.inc(wallbox=self.destination[0])
+                attempts += 1
+                await self._transmit(message)
                 resend = False
             try:
-                data, addr = await asyncio.wait_for(self.sock.recvfrom(), timeout=RESPONSE_TIMEOUT)
+                response = await asyncio.wait_for(asyncio.shield(future), timeout=RESPONSE_TIMEOUT)
             except TimeoutError:
-                print(f"Did not receive a response in time, resending {message}")
+                logger.info("resend wallbox=%s request=%s", self.destination[0], key)
                 resend = True
                 continue
-            response = data.decode("utf-8")
-            if addr != DESTINATION:
-                print(f"Received packet from unauthorized address {addr}, ignoring")
-                continue
-            if not response_validator(response):
-                print(f"Response received did not pass validation, ignoring")
-                print(f"Request was {message}, response was {response}")
-                continue
+            # Keep the number of label values small, history entries share a single one
+            request = "history" if key.isdigit() and int(key) >= HISTORY_FIRST_REPORT else key
+            report_latency.observe(time.monotonic() - start, wallbox=self.destination[0], request=request)
             return response
 
-    async def search_for_new_sessions(self):
-        # report 100 is always the currently running session, 101 is sometimes the running session (but not always)
-        for history_entries in range(1, 31):
-            history_id = 100 + history_entries
-            report = ("report " + str(history_id)).encode("utf-8")
-            entry = json.loads(await self._send(report, functools.partial(validate_history_report, history_id)))
-            session_id = entry["Session ID"]
+    async def _fetch_history(self, positions):
+        responses = await asyncio.gather(*(self._send(history_request(position)) for position in positions))
+        return dict(zip(positions, responses))
+
+    async def search_for_new_sessions(self, current_session):
+        newest = (await self._fetch_history([0]))[0]
+        # Session IDs are only unique per wallbox, so the serial is part of everything we compare
+        serial = newest.serial
+        fingerprint = (serial, current_session.session_id, current_session.ended_seconds,
+                       newest.session_id, newest.ended_seconds)
+        if fingerprint == self.history_fingerprint:
+            logger.debug("history_unchanged wallbox=%s", self.destination[0])
+            return
+        newest_id = newest.session_id
+        if newest_id < 1:
+            # Empty history
+            self.history_fingerprint = fingerprint
+            return
+        # Session IDs are handed out sequentially, so position N of the history should hold newest_id - N.
+        # Checking the whole window (instead of stopping at the first known session) closes holes
+        # left behind by an interrupted sync.
+        expected = {position: newest_id - position for position in range(HISTORY_SIZE) if newest_id - position >= 1}
+        pending = {session_id for pending_serial, session_id in self.writer.sessions if pending_serial == serial}
+        known = await ChargeSession.find_known_sessions(serial, expected.values()) | pending
+        missing = [position for position, session_id in expected.items() if session_id not in known]
+        entries = {0: newest}
+        entries.update(await self._fetch_history([position for position in missing if position != 0]))
+        fetched = len(entries)
+        candidates = [entries[position] for position in missing]
+        if any(entry.session_id not in (expected[position], -1) for position, entry in entries.items()):
+            # History is not sequential (e.g. after a reset of the wallbox), fall back to fetching all entries
+            logger.info("history_not_sequential wallbox=%s", self.destination[0])
+            entries.update(await self._fetch_history([p for p in range(HISTORY_SIZE) if p not in entries]))
+            fetched = len(entries)
+            candidates = [entry for entry in entries.values() if entry.session_id >= 1]
+            known = await ChargeSession.find_known_sessions(serial, (entry.session_id for entry in candidates)) \
+                | pending
+            candidates = [entry for entry in candidates if entry.session_id not in known]
+        for entry in candidates:
+            session_id = entry.session_id
             if session_id == -1:
-                # Empty entry. All subsequent ones will be empty too.
-                break
-            if entry["reason"] not in [1, 10] and int(entry["ended[s]"]) == 0:
-                # Charging session is still running (note that this has been observed to use undocumented reason IDs)
-                # Skip it for now
-                print(f"Debug: Skipping currently running session {session_id}")
+                # Empty entry
                 continue
-            if await ChargeSession.try_find_session(session_id):
-                # We already know this session, so we also know all subsequent ones.
-                break
-            print("New session!")
-            print(f"{json.dumps(entry, indent=4)}")
+            if not session_finished(entry):
+                # Charging session is still running, skip it for now
+                logger.debug("skip_running_session wallbox=%s session=%s", self.destination[0], session_id)
+                continue
+            logger.info("new_session wallbox=%s session=%s energy=%s", self.destination[0], session_id, entry.energy_present)
             # This is a new session, save it
-            await add_charge_session(entry)
+            self.writer.submit_session(entry, self.received[str(entry.report_id)])
+        history_scan_length.observe(fetched, wallbox=self.destination[0])
+        self.history_fingerprint = fingerprint
+
+    async def poll(self, reports):
+        if SYSTEM_STATUS in reports:
+            await self._send(BUILDUP)
+        # Requests are pipelined: each one goes out as soon as the send rate allows, without waiting for earlier replies
+        responses = await asyncio.gather(*(self._send(report) for report in reports),
+                                         return_exceptions=True)
+        for response in responses:
+            if isinstance(response, BaseException):
+                raise response
+        statuses = dict(zip(reports, responses))
+        if logger.isEnabledFor(logging.DEBUG):
+            for report, response in statuses.items():
+                logger.debug("report wallbox=%s request=%s data=%s", self.destination[0], request_key(report), response)
+        if CONFIGURATION_STATUS in statuses:
+            self.last_state = statuses[CONFIGURATION_STATUS].state
+        for report, response in statuses.items():
+            self.writer.submit(self.destination, response, self.received[request_key(report)])
+        current_session = statuses.get(CURRENT_SESSION_STATUS)
+        if current_session is not None:
+            session = (current_session.serial, current_session.session_id, current_session.ended_seconds)
+            if session != self.last_session:
+                # The history only changes when a session starts or ends
+                await self.search_for_new_sessions(current_session)
+                self.last_session = session
 
     async def probe(self):
-        await self._send(BUILDUP, validate_anything)
-        system_status = json.loads(await self._send(SYSTEM_STATUS, validate_system_status))
-        print(f"System status: {json.dumps(system_status, indent=4)}")
-        config_status = json.loads(await self._send(CONFIGURATION_STATUS, validate_config_status))
-        print(f"Config status: {json.dumps(config_status, indent=4)}")
-        self.last_state = int(config_status['State'])
-        charging_status = json.loads(await self._send(CHARGING_STATUS, validate_charging_status))
-        print(f"Charging status: {json.dumps(charging_status, indent=4)}")
-        current_session = json.loads(await self._send(CURRENT_SESSION_STATUS, validate_current_charge_session))
-        print(f"Current session: {json.dumps(current_session, indent=4)}")
-        await update_from_report(system_status)
-        await update_from_report(config_status)
-        await update_from_report(charging_status)
-        await update_from_report(current_session)
-        await self.search_for_new_sessions()
-        return True
-
-    async def receive_status(self):
-        interval = PROBE_INTERVAL_RUNNING if self.last_state == 3 else PROBE_INTERVAL
+        await self.poll(list(REPORT_INTERVALS))
+
+    def interval(self, report):
+        idle, charging = REPORT_INTERVALS[report]
+        return charging if self.last_state == 3 else idle
+
+    def schedule(self, report, now):
+        self.next_poll[report] = now + self.interval(report) * random.uniform(1 - SCHEDULE_JITTER, 1 + SCHEDULE_JITTER)
+
+    def schedule_probe(self):
+        now = time.monotonic()
+        for report in REPORT_INTERVALS:
+            self.next_poll[report] = now
+
+    def expedite(self, now, skip):
+        # Charging started or stopped, don't wait for the interval of the previous state to run out
+        for report in REPORT_INTERVALS:
+            if report not in skip:
+                self.next_poll[report] = min(self.next_poll[report], now + self.interval(report))
+
+    async def handle_push(self, push, received):
+        name, value = push.name, push.value
+        if self.last_success is None:
+            # Nothing to apply the push to yet
+            self.schedule_probe()
+            return
+        previous_state = self.last_state
+        if name == "State":
+            self.last_state = value
+        self.writer.submit(self.destination, push, received)
+        now = time.monotonic()
+        for report in PUSH_REPORTS[name]:
+            self.next_poll[report] = now
+        if self.last_state != previous_state:
+            self.expedite(now, PUSH_REPORTS[name])
+
+    async def receive_status(self, timeout):
+        try:
+            received, push = await asyncio.wait_for(self.pushes.get(), timeout=timeout)
+        except TimeoutError:
+            return
+        if push is None:
+            # An invalid push was received, we may have missed a change
+            self.schedule_probe()
+            return
+        logger.debug("push wallbox=%s data=%s", self.destination[0], push)
+        pushes_received.inc(wallbox=self.destination[0], type=push.name)
+        await self.handle_push(push, received)
+
+    async def run(self, start_delay=0):
+        self.next_poll = {report: time.monotonic() + start_delay for report in REPORT_INTERVALS}
+        failures = 0
         while True:
+            now = time.monotonic()
+            next_poll = min(self.next_poll.values())
+            if next_poll > now:
+                await self.receive_status(next_poll - now)
+                continue
+            due = [report for report, at in self.next_poll.items() if at <= now + SCHEDULE_COALESCE]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("poll wallbox=%s requests=%s state=%s", self.destination[0],
+                             ",".join(request_key(report) for report in due), self.last_state)
+            previous_state = self.last_state
             try:
-                data, addr = await asyncio.wait_for(self.sock.recvfrom(), timeout=interval)
-            except TimeoutError:
-                return None
-            response = data.decode("utf-8")
-            if addr != DESTINATION:
-                print(f"Received packet from unauthorized address {addr}, ignoring")
+                await self.poll(due)
+            except WallboxUnreachable as e:
+                failures += 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1)) * random.uniform(0.5, 1)
+                logger.warning("unreachable wallbox=%s failures=%s retry_in=%.0f", self.destination[0], failures, delay)
+                for report in due:
+                    self.next_poll[report] = time.monotonic() + delay
                 continue
-            if not validate_progress_report(response):
-                global schedule_probe
-                print(
-                    f"Expected to receive progress report message, but received message did not pass validation, scheduling probe")
-                print(f"Response was {response}")
-                return False
-            report = json.loads(response)
-            print(f"Received status message {report}")
-            if not report.get("E pres", None):
-                print("Some state changed (except energy meter), scheduling probe")
-                return False
-            return True
+            failures = 0
+            now = time.monotonic()
+            for report in due:
+                self.schedule(report, now)
+            if self.last_state != previous_state:
+                self.expedite(now, due)
+            self.last_success = time.time()
+
+
+class HealthReporter:
+    """
+    Notifies the health check URL about successful polls, at most once per HEALTHCHECK_INTERVAL.
+    If the URL contains {wallbox}, every wallbox is reported separately (the placeholder is replaced by
+    its IP address). Otherwise, the URL is only notified while all wallboxes are healthy.
+    """
+
+    def __init__(self, url, communicators):
+        self.url = url
+        self.communicators = communicators
+        self.last_reported = {}
+        # Requests run in a dedicated thread, which also owns the (kept alive) connections
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="healthcheck")
+        self.connections = {}
+
+    def _get(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        connection = self.connections.get(key)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+            connection = connection_class(parts.netloc, timeout=HEALTHCHECK_TIMEOUT)
+            self.connections[key] = connection
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            del self.connections[key]
+            raise
+        return response.status
+
+    def targets(self):
+        if "{wallbox}" in self.url:
+            for communicator in self.communicators:
+                yield self.url.replace("{wallbox}", communicator.destination[0]), communicator.last_success
+        else:
+            successes = [communicator.last_success for communicator in self.communicators]
+            yield self.url, None if None in successes else min(successes)
+
+    async def report(self):
+        loop = asyncio.get_running_loop()
+        for url, last_success in self.targets():
+            if last_success is None or last_success <= self.last_reported.get(url, 0):
+                # Nothing succeeded since the last notification
+                continue
+            try:
+                status = await loop.run_in_executor(self.executor, self._get, url)
+            except (OSError, http.client.HTTPException) as e:
+                logger.warning("healthcheck_failed url=%s error=%s", url, e)
+                continue
+            if status >= 400:
+                logger.warning("healthcheck_status url=%s status=%s", url, status)
+            self.last_reported[url] = last_success
+
+    async def run(self):
+        if not self.url:
+            return
+        while True:
+            await asyncio.sleep(HEALTHCHECK_INTERVAL)
+            await self.report()
 
-    def __del__(self):
-        self.sock.close()
+
+async def maintain_telemetry_periodically():
+    while True:
+        await asyncio.sleep(TELEMETRY_MAINTENANCE_INTERVAL)
+        try:
+            await sync_to_async(maintain_telemetry)()
+        except DatabaseError as e:
+            logger.error("telemetry_rollup_failed error=%s", e)
+
+
+async def write_metrics_periodically():
+    if not METRICS:
+        return
+    while True:
+        await asyncio.sleep(METRICS_WRITE_INTERVAL)
+        try:
+            REGISTRY.write(METRICS_FILE)
+        except OSError as e:
+            logger.error("metrics_write_failed file=%s error=%s", METRICS_FILE, e)
 
 
 def stop(loop):
     loop.stop()
 
 
+async def serve(sock, wallbox_ips, communicator_class=WallboxCommunicator, healthcheck_url=HEALTHCHECK_URL,
+                capture=None, writer=None):
+    """
+    Talks to the given wallboxes over the given socket, until cancelled.
+    """
+    dispatcher = WallboxDispatcher(sock, capture)
+    writer = writer or DatabaseWriter()
+    communicators = [communicator_class(sock, (ip, WALLBOX_PORT), writer) for ip in wallbox_ips]
+    for communicator in communicators:
+        dispatcher.register(communicator)
+    if os.name == 'posix':
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dispatcher.dump_recent)
+    logger.info("start wallboxes=%s", ",".join(wallbox_ips))
+    health_reporter = HealthReporter(healthcheck_url, communicators)
+    await asyncio.gather(dispatcher.run(), writer.run(), maintain_telemetry_periodically(), health_reporter.run(),
+                         write_metrics_periodically(),
+                         *(communicator.run(start_delay=index * STARTUP_SPREAD / len(communicators))
+                           for index, communicator in enumerate(communicators)))
+
+
 async def main():
-    global schedule_probe
     loop = asyncio.get_running_loop()
     if os.name == 'posix':
         for signame in {'SIGINT', 'SIGTERM'}:
             loop.add_signal_handler(getattr(signal, signame), functools.partial(stop, loop))
-        print(f"Starting endless loop; Send CTRL+C (SIGINT or SIGTERM) to exit.")
+        logger.info("Starting endless loop; Send CTRL+C (SIGINT or SIGTERM) to exit, SIGUSR1 to dump recent datagrams.")
     else:
-        print(f"Starting endless loop")
-    schedule_probe = True
-    sock = await asyncudp.create_socket(local_addr=SOURCE, remote_addr=DESTINATION)
-    comm = WallboxCommunicator(sock)
-    last_probe = time.time()
-    while True:
-        interval = PROBE_INTERVAL_RUNNING if comm.last_state == 3 else PROBE_INTERVAL
-        print(f"Debug: using interval {interval}, state {comm.last_state}")
-        if schedule_probe or (time.time() - last_probe) >= interval:
-            if await comm.probe():
-                last_probe = time.time()
-                schedule_probe = False
-                try:
-                    loop = asyncio.get_event_loop()
-                    future = loop.run_in_executor(None, urllib.request.urlopen, HEALTHCHECK_URL)
-                    await future
-                except URLError:
-                    print("Unable to notify probe success to health checks")
+        logger.info("Starting endless loop")
+    # All wallboxes talk to the same local port, so a single socket serves the whole fleet
+    sock = await asyncudp.create_socket(local_addr=SOURCE)
+    capture = CaptureWriter(CAPTURE_FILE) if CAPTURE_FILE else None
+    if capture is not None:
+        logger.info("capture file=%s", CAPTURE_FILE)
+    try:
+        await serve(sock, WALLBOX_IPS, capture=capture)
+    finally:
+        sock.close()
+        if capture is not None:
+            capture.close()
+
+
+class Replayer:
+    """
+    Feeds captured datagrams through decoding and persistence like live traffic, without talking to any wallbox.
+    Replies are persisted as if they had been polled, history entries are added if they are new.
+    """
+
+    def __init__(self):
+        self.writer = DatabaseWriter()
+        # Wallboxes we have seen a report of, pushes can't be applied before
+        self.known_wallboxes = set()
+        self.datagrams = 0
+        self.rejected = 0
+
+    async def feed(self, addr, data, received):
+        self.datagrams += 1
+        try:
+            report = decode(data)
+        except InvalidReport as e:
+            logger.warning("invalid_reply wallbox=%s request=%s data=%s", addr[0], e.report_id,
+                           data.decode("utf-8", "replace"))
+            self.rejected += 1
+            return
+        if report is None:
+            # Probably the reply to "i", nothing to persist
+            return
+        if len(self.writer.updates) >= self.writer.size:
+            # Unlike live traffic, wait for the database instead of dropping data
+            await self.writer.idle.wait()
+        if isinstance(report, Push):
+            if addr in self.known_wallboxes and report.name in PUSH_REPORTS:
+                self.writer.submit(addr, report, received)
+        elif report.report_id >= HISTORY_FIRST_REPORT:
+            if report.session_id >= 1 and session_finished(report) \
+                    and (report.serial, report.session_id) not in self.writer.sessions \
+                    and await ChargeSession.try_find_session(report.serial, report.session_id) is None:
+                logger.info("new_session wallbox=%s session=%s energy=%s", addr[0], report.session_id,
+                            report.energy_present)
+                self.writer.submit_session(report, received)
         else:
-            if not await comm.receive_status():
-                schedule_probe = True
+            self.known_wallboxes.add(addr)
+            self.writer.submit(addr, report, received)
+
+    async def replay(self, path, speed):
+        writer = asyncio.create_task(self.writer.run())
+        started = time.monotonic()
+        first = None
+        try:
+            for timestamp, addr, data in read_capture(path):
+                if first is None:
+                    first = timestamp
+                if speed:
+                    # Keep the pace of the capture
+                    delay = (timestamp - first) / speed - (time.monotonic() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                # The receive time of the capture anchors the timestamps, not the time of the replay
+                await self.feed(addr, data, timestamp)
+            await self.writer.idle.wait()
+        finally:
+            writer.cancel()
+        return time.monotonic() - started
 
 
 class Command(BaseCommand):
     help = "Talk to Wallbox, receive charge sessions, status reports and control messages"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--replay", metavar="CAPTURE_FILE",
+                            help="Instead of talking to the wallboxes, persist the datagrams of a capture file "
+                                 "(see CAPTURE_FILE) to the database")
+        parser.add_argument("--replay-speed", type=float, default=1,
+                            help="Replay speed relative to the capture, 0 replays as fast as possible")
+
     def handle(self, **options) -> str:
+        if options["replay"]:
+            replayer = Replayer()
+            duration = asyncio.run(replayer.replay(options["replay"], options["replay_speed"]))
+            return (f"Replayed {replayer.datagrams} datagrams ({replayer.rejected} rejected) in {duration:.1f}s, "
+                    f"{replayer.datagrams / max(duration, 0.001):.0f} datagrams/s.")
         asyncio.run(main())
         return "Exit."
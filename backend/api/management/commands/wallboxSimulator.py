@@ -0,0 +1,45 @@
+import asyncio
+
+from django.core.management import BaseCommand
+
+from api.simulator import Simulator, HISTORY_SIZE
+
+
+class Command(BaseCommand):
+    help = "Simulate KEBA wallboxes on local loopback addresses, for development and benchmarking of wallboxIO"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=1, help="Number of simulated wallboxes")
+        parser.add_argument("--base-address", default="127.0.1.1",
+                            help="Address of the first wallbox, further wallboxes use the following addresses")
+        parser.add_argument("--latency", type=float, default=0.01, help="Mean response latency in seconds")
+        parser.add_argument("--loss", type=float, default=0.0, help="Probability of dropping a datagram")
+        parser.add_argument("--duplicates", type=float, default=0.0,
+                            help="Probability of sending a datagram twice")
+        parser.add_argument("--history", type=int, default=HISTORY_SIZE,
+                            help="Number of finished sessions in the history at startup")
+        parser.add_argument("--session-length", type=float, default=1800, help="Mean charge session length in seconds")
+        parser.add_argument("--idle-length", type=float, default=600, help="Mean time between sessions in seconds")
+        parser.add_argument("--push-interval", type=float, default=30,
+                            help="Seconds between E pres pushes while charging")
+
+    def handle(self, **options):
+        simulator = Simulator(options["count"], base_address=options["base_address"], latency=options["latency"],
+                              loss=options["loss"], duplicates=options["duplicates"], history=options["history"],
+                              session_length=options["session_length"], idle_length=options["idle_length"],
+                              push_interval=options["push_interval"])
+        try:
+            asyncio.run(self.simulate(simulator))
+        except KeyboardInterrupt:
+            pass
+        return f"Answered {simulator.requests} requests, sent {simulator.pushes} pushes."
+
+    async def simulate(self, simulator):
+        try:
+            await simulator.start()
+            # The benchmark waits for this line before it starts talking to us
+            self.stdout.write(f"Simulating wallboxes={','.join(simulator.addresses)}")
+            self.stdout.flush()
+            await simulator.run()
+        finally:
+            simulator.close()
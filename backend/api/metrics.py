@@ -0,0 +1,123 @@
+import bisect
+import os
+import threading
+from collections import defaultdict
+
+# Default histogram buckets, suitable for latencies in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, lock):
+        self.name = name
+        self.documentation = documentation
+        self.values = defaultdict(float)
+        self._lock = lock
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+
+class Gauge:
+    def __init__(self, name, documentation, lock):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self._lock = lock
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, lock, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # Per label set: bucket counts (the last one being +Inf), sum
+        self.values = {}
+        self._lock = lock
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(labels)} {total}"
+            yield f"{self.name}_count{format_labels(labels)} {cumulative}"
+
+
+class Registry:
+    """
+    A minimal collection of metrics that renders to the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation):
+        metric = Counter(name, documentation, self._lock)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation):
+        metric = Gauge(name, documentation, self._lock)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, self._lock, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            lines = [line for metric in self.metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Write atomically, so readers never see a partial file
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            file.write(self.render())
+        os.replace(temporary, path)
+
+
+REGISTRY = Registry()
@@ -0,0 +1,74 @@
+import contextvars
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from api.metrics import REGISTRY
+
+request_duration = REGISTRY.histogram("api_request_duration_seconds", "Time spent handling requests, by view")
+request_queries = REGISTRY.histogram("api_request_queries", "Database queries per request, by view",
+                                     buckets=(0, 1, 2, 5, 10, 25, 50, 100))
+
+# Queries of the current request. A context variable, so the queries async views run in a thread are counted as well.
+query_count = contextvars.ContextVar("query_count", default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    queries = query_count.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection, **kwargs):
+    # Also sent when a closed connection is reopened
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class MetricsMiddleware:
+    """
+    Records the latency and the number of database queries of every request. Sync and async capable, so async views
+    are not moved to a thread for it.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+        connection_created.connect(install_query_counter, dispatch_uid="api.middleware.install_query_counter")
+        for connection in connections.all(initialized_only=True):
+            install_query_counter(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = [0]
+        token = query_count.set(queries)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            query_count.reset(token)
+        self.observe(request, time.perf_counter() - start, queries[0])
+        return response
+
+    async def __acall__(self, request):
+        queries = [0]
+        token = query_count.set(queries)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            query_count.reset(token)
+        self.observe(request, time.perf_counter() - start, queries[0])
+        return response
+
+    def observe(self, request, duration, queries):
+        view = request.resolver_match.view_name if request.resolver_match else "unresolved"
+        request_duration.observe(duration, view=view, method=request.method)
+        request_queries.observe(queries, view=view, method=request.method)
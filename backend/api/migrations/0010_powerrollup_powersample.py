@@ -0,0 +1,51 @@
+# Generated by Django 6.0.3 on 2026-10-18 11:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_wallbox_currentendtime'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PowerRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField(choices=[(60, '1 minute'), (900, '15 minutes'), (3600, '1 hour')], help_text='s')),
+                ('start', models.DateTimeField()),
+                ('samples', models.IntegerField()),
+                ('powerAvg', models.IntegerField(help_text='mW')),
+                ('powerMin', models.IntegerField(help_text='mW')),
+                ('powerMax', models.IntegerField(help_text='mW')),
+                ('wallbox', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.wallbox')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('wallbox', 'resolution', 'start'), name='api_powerrollup_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PowerSample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sessionID', models.IntegerField(default=None, null=True)),
+                ('timestamp', models.DateTimeField()),
+                ('power', models.IntegerField(help_text='mW')),
+                ('powerFactor', models.SmallIntegerField(help_text='0.1 %')),
+                ('energy', models.IntegerField(help_text='Energy of the current session, 0.1 Wh')),
+                ('phase1_voltage', models.SmallIntegerField(help_text='V')),
+                ('phase2_voltage', models.SmallIntegerField(help_text='V')),
+                ('phase3_voltage', models.SmallIntegerField(help_text='V')),
+                ('phase1_current', models.IntegerField(help_text='mA')),
+                ('phase2_current', models.IntegerField(help_text='mA')),
+                ('phase3_current', models.IntegerField(help_text='mA')),
+                ('wallbox', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.wallbox')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['wallbox', 'timestamp'], name='api_powersample_wallbox'), models.Index(fields=['sessionID', 'timestamp'], name='api_powersample_session')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.3 on 2026-10-18 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_powerrollup_powersample'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chargesession',
+            index=models.Index(fields=['started', 'sessionID'], name='api_chargesession_started'),
+        ),
+    ]
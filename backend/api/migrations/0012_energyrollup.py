@@ -0,0 +1,43 @@
+# Generated by Django 6.0.3 on 2026-10-18 11:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def build_rollups(apps, schema_editor):
+    # Same as api.energy.rebuild_energy_rollups(), for the sessions recorded so far
+    ChargeSession = apps.get_model('api', 'ChargeSession')
+    EnergyRollup = apps.get_model('api', 'EnergyRollup')
+    rows = ChargeSession.objects.annotate(day=TruncDate('started')).order_by().values(
+        'day', 'token', 'wallboxSerial').annotate(sessionCount=Count('pk'), energy=Sum('chargedEnergy'))
+    EnergyRollup.objects.bulk_create(
+        [EnergyRollup(day=row['day'], token_id=row['token'], wallbox_id=row['wallboxSerial'],
+                      sessions=row['sessionCount'], chargedEnergy=row['energy']) for row in rows],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_chargesession_started'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnergyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('sessions', models.IntegerField()),
+                ('chargedEnergy', models.DecimalField(decimal_places=1, max_digits=12)),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.rfidtoken')),
+                ('wallbox', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.wallbox')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'token', 'wallbox'), name='api_energyrollup_unique')],
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
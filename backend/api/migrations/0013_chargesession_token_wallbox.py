@@ -0,0 +1,21 @@
+# Generated by Django 6.0.3 on 2026-10-18 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_energyrollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chargesession',
+            index=models.Index(fields=['token', 'started'], name='api_chargesession_token'),
+        ),
+        migrations.AddIndex(
+            model_name='chargesession',
+            index=models.Index(fields=['wallboxSerial', 'started'], name='api_chargesession_wallbox'),
+        ),
+    ]
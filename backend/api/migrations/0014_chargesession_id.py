@@ -0,0 +1,91 @@
+# Generated by Django 6.0.3 on 2026-10-18 12:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def copy_sessions(apps, schema_editor, source='ChargeSession', target='NewChargeSession', ignore_conflicts=False):
+    # Session IDs are only unique per wallbox: Sessions move to a table with a surrogate primary key, numbered in
+    # the order of their session IDs
+    source = apps.get_model('api', source)
+    target = apps.get_model('api', target)
+    fields = [field.attname for field in source._meta.concrete_fields if field.attname != 'id']
+    sessions = []
+    for row in source.objects.order_by('sessionID').values(*fields).iterator(chunk_size=BATCH_SIZE):
+        sessions.append(target(**row))
+        if len(sessions) >= BATCH_SIZE:
+            target.objects.bulk_create(sessions, ignore_conflicts=ignore_conflicts)
+            sessions = []
+    target.objects.bulk_create(sessions, ignore_conflicts=ignore_conflicts)
+
+
+def copy_sessions_back(apps, schema_editor):
+    # Of sessions sharing an ID (of different wallboxes), only the first one fits into the old table
+    copy_sessions(apps, schema_editor, source='NewChargeSession', target='ChargeSession', ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_chargesession_token_wallbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NewChargeSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                # Copied as they are, see below
+                ('created', models.DateTimeField()),
+                ('sessionID', models.IntegerField()),
+                ('hardwareCurrentLimit', models.IntegerField()),
+                ('energyMeterAtStart', models.DecimalField(decimal_places=1, max_digits=9)),
+                ('chargedEnergy', models.DecimalField(decimal_places=1, max_digits=9)),
+                ('started', models.DateTimeField()),
+                ('ended', models.DateTimeField()),
+                ('timesource', models.CharField(choices=[('WALLBOX_TIME_NTP', 'Wallbox self-synchronized NTP time'), ('WALLBOX_TIME_WEAK', 'Wallbox weak synced time'), ('SERVER_TIME', 'Server time based on Wallbox timer offset'), ('TIME_UNKNOWN', 'Unknown time source')], default='TIME_UNKNOWN', max_length=255)),
+                ('stopReason', models.CharField(choices=[('SESSION_RUNNING', 'Charging session has not ended.'), ('SESSION_CABLE_UNPLUGGED', 'Charging session was terminated by unplugging.'), ('SESSION_CARD_DEAUTH', 'Charging session was terminated via deauthorization with the RFID card used for starting the session.'), ('SESSION_STATUS_UNKNOWN', "The session's status is unknown.")], default='SESSION_STATUS_UNKNOWN', max_length=255)),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='api.rfidtoken')),
+                ('wallboxSerial', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='api.wallbox')),
+            ],
+        ),
+        migrations.RunPython(copy_sessions, copy_sessions_back),
+        migrations.DeleteModel(
+            name='ChargeSession',
+        ),
+        migrations.RenameModel(
+            old_name='NewChargeSession',
+            new_name='ChargeSession',
+        ),
+        migrations.AlterField(
+            model_name='chargesession',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterModelOptions(
+            name='chargesession',
+            options={'ordering': ('sessionID', 'id')},
+        ),
+        migrations.AddIndex(
+            model_name='chargesession',
+            index=models.Index(fields=['sessionID', 'id'], name='api_chargesession_session'),
+        ),
+        migrations.AddIndex(
+            model_name='chargesession',
+            index=models.Index(fields=['started', 'id'], name='api_chargesession_started'),
+        ),
+        migrations.AddIndex(
+            model_name='chargesession',
+            index=models.Index(fields=['token', 'started'], name='api_chargesession_token'),
+        ),
+        migrations.AddIndex(
+            model_name='chargesession',
+            index=models.Index(fields=['wallboxSerial', 'started'], name='api_chargesession_wallbox'),
+        ),
+        migrations.AddConstraint(
+            model_name='chargesession',
+            constraint=models.UniqueConstraint(fields=('wallboxSerial', 'sessionID'), name='api_chargesession_unique'),
+        ),
+    ]
@@ -179,13 +179,25 @@ class Wallbox(models.Model):
             return cls.PLUG_CABLE_UNKNOWN
 
 
-# A charge session recorded by the wallbox.
+# A charge session recorded by the wallbox. Session IDs are only unique per wallbox.
 class ChargeSession(models.Model):
     class Meta:
-        ordering = ('sessionID',)
+        ordering = ('sessionID', 'id')
+        constraints = [
+            models.UniqueConstraint(fields=['wallboxSerial', 'sessionID'], name="%(app_label)s_%(class)s_unique"),
+        ]
+        indexes = [
+            # The ordering by session ID of the session list
+            models.Index(fields=['sessionID', 'id'], name="%(app_label)s_%(class)s_session"),
+            # Date filters and the ordering by start time of the session list
+            models.Index(fields=['started', 'id'], name="%(app_label)s_%(class)s_started"),
+            # Date filters of the session list combined with a token or wallbox filter
+            models.Index(fields=['token', 'started'], name="%(app_label)s_%(class)s_token"),
+            models.Index(fields=['wallboxSerial', 'started'], name="%(app_label)s_%(class)s_wallbox"),
+        ]
 
     created = models.DateTimeField(auto_now_add=True)
-    sessionID = models.IntegerField(primary_key=True)
+    sessionID = models.IntegerField()
     hardwareCurrentLimit = models.IntegerField()
     energyMeterAtStart = models.DecimalField(max_digits=9, decimal_places=1)
     chargedEnergy = models.DecimalField(max_digits=9, decimal_places=1)
@@ -197,15 +209,20 @@ class ChargeSession(models.Model):
     wallboxSerial = models.ForeignKey(Wallbox, on_delete=models.PROTECT)
 
     def __str__(self):
-        return str(self.sessionID)
+        return f"{self.wallboxSerial_id}/{self.sessionID}"
 
     @classmethod
-    async def try_find_session(cls, session_id):
+    async def try_find_session(cls, serial, session_id):
         try:
-            return await cls.objects.aget(sessionID=session_id)
+            return await cls.objects.aget(wallboxSerial=serial, sessionID=session_id)
         except cls.DoesNotExist:
             return None
 
+    @classmethod
+    async def find_known_sessions(cls, serial, session_ids):
+        sessions = cls.objects.filter(wallboxSerial=serial, sessionID__in=list(session_ids))
+        return {session_id async for session_id in sessions.values_list('sessionID', flat=True)}
+
     @classmethod
     def time_status_from_raw(cls, raw_id):
         raw_id = str(raw_id)
@@ -232,6 +249,73 @@ class ChargeSession(models.Model):
             return SESSION_STATUS_UNKNOWN
 
 
+# Charged energy of the sessions of a token at a wallbox, by the (local) day the sessions started.
+# Maintained by wallboxIO as it records sessions, see api.energy.
+class EnergyRollup(models.Model):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'token', 'wallbox'], name="%(app_label)s_%(class)s_unique")
+        ]
+
+    day = models.DateField()
+    token = models.ForeignKey(RFIDToken, on_delete=models.CASCADE)
+    wallbox = models.ForeignKey(Wallbox, on_delete=models.CASCADE)
+    sessions = models.IntegerField()
+    chargedEnergy = models.DecimalField(max_digits=12, decimal_places=1)
+
+
+# A single charging status sample (report 3). Values are stored as the integer fixed point units sent by the wallbox.
+class PowerSample(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['wallbox', 'timestamp'], name="%(app_label)s_%(class)s_wallbox"),
+            models.Index(fields=['sessionID', 'timestamp'], name="%(app_label)s_%(class)s_session"),
+        ]
+
+    wallbox = models.ForeignKey(Wallbox, on_delete=models.CASCADE)
+    # The running session, if any. Not a foreign key since running sessions are not recorded yet.
+    sessionID = models.IntegerField(null=True, default=None)
+    timestamp = models.DateTimeField()
+    power = models.IntegerField(help_text="mW")
+    powerFactor = models.SmallIntegerField(help_text="0.1 %")
+    energy = models.IntegerField(help_text="Energy of the current session, 0.1 Wh")
+    phase1_voltage = models.SmallIntegerField(help_text="V")
+    phase2_voltage = models.SmallIntegerField(help_text="V")
+    phase3_voltage = models.SmallIntegerField(help_text="V")
+    phase1_current = models.IntegerField(help_text="mA")
+    phase2_current = models.IntegerField(help_text="mA")
+    phase3_current = models.IntegerField(help_text="mA")
+
+
+# Power samples downsampled into fixed time buckets.
+class PowerRollup(models.Model):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['wallbox', 'resolution', 'start'], name="%(app_label)s_%(class)s_unique")
+        ]
+
+    RESOLUTIONS = {
+        60: "1 minute",
+        900: "15 minutes",
+        3600: "1 hour",
+    }
+    wallbox = models.ForeignKey(Wallbox, on_delete=models.CASCADE)
+    resolution = models.IntegerField(choices=RESOLUTIONS, help_text="s")
+    start = models.DateTimeField()
+    samples = models.IntegerField()
+    powerAvg = models.IntegerField(help_text="mW")
+    powerMin = models.IntegerField(help_text="mW")
+    powerMax = models.IntegerField(help_text="mW")
+
+    @classmethod
+    def resolution_for(cls, duration):
+        # Pick the finest resolution that keeps a curve at a few hundred points
+        for resolution in sorted(cls.RESOLUTIONS):
+            if duration.total_seconds() / resolution <= 500:
+                return resolution
+        return max(cls.RESOLUTIONS)
+
+
 # Don't show sensitive tables in the admin UI. This makes it harder to perform accidental modifications.
 # (But do show it for development purposes)
 if settings.DEBUG:
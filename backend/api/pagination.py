@@ -0,0 +1,15 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ChargeSessionPagination(CursorPagination):
+    """
+    Opt-in keyset pagination: Responses are only paginated if the client asks for a page_size.
+    Pages continue from the position of the previous page (instead of an offset), so they are read from the index
+    of the ordering field and the table is never counted.
+    """
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_ordering(self, request, queryset, view):
+        return view.get_ordering()
@@ -0,0 +1,141 @@
+import json
+from dataclasses import dataclass
+
+# Records use the integer fixed-point units of the wallbox:
+# power in mW, current in mA, energy in 0.1 Wh, power factor in 0.1 %, voltage in V, times in seconds since boot.
+
+
+class InvalidReport(ValueError):
+    def __init__(self, report_id, data):
+        super().__init__(f"Invalid report {report_id}: {data}")
+        self.report_id = report_id
+        self.data = data
+
+
+@dataclass(slots=True)
+class SystemReport:
+    serial: str
+    sec: int
+    product: str
+    firmware: str
+    time_q: int
+    report_id: int = 1
+
+
+@dataclass(slots=True)
+class ConfigReport:
+    serial: str
+    sec: int
+    state: int
+    plug: int
+    report_id: int = 2
+
+
+@dataclass(slots=True)
+class ChargingReport:
+    serial: str
+    sec: int
+    power: int
+    power_factor: int
+    energy_present: int
+    energy_total: int
+    voltage1: int
+    voltage2: int
+    voltage3: int
+    current1: int
+    current2: int
+    current3: int
+    report_id: int = 3
+
+
+@dataclass(slots=True)
+class SessionReport:
+    """
+    A charge session: the current one (report 100) or an entry of the history (reports 101 to 130).
+    Empty history entries have session_id -1.
+    """
+    report_id: int
+    serial: str
+    sec: int
+    session_id: int
+    hardware_limit: int
+    energy_start: int
+    energy_present: int
+    started_seconds: int
+    ended_seconds: int
+    # Wall clock times, only meaningful if time_q indicates a synchronized clock
+    started: str
+    ended: str
+    reason: int
+    time_q: str
+    rfid_tag: str
+    rfid_class: str
+
+
+@dataclass(slots=True)
+class Push:
+    name: str
+    value: int
+
+
+def decode_system(report):
+    return SystemReport(serial=report['Serial'], sec=int(report['Sec']), product=report['Product'],
+                        firmware=report['Firmware'], time_q=int(report['timeQ']))
+
+
+def decode_config(report):
+    return ConfigReport(serial=report['Serial'], sec=int(report['Sec']), state=int(report['State']),
+                        plug=int(report['Plug']))
+
+
+def decode_charging(report):
+    return ChargingReport(serial=report['Serial'], sec=int(report['Sec']), power=int(report['P']),
+                          power_factor=int(report['PF']), energy_present=int(report['E pres']),
+                          energy_total=int(report['E total']), voltage1=int(report['U1']),
+                          voltage2=int(report['U2']), voltage3=int(report['U3']), current1=int(report['I1']),
+                          current2=int(report['I2']), current3=int(report['I3']))
+
+
+def decode_session(report_id, report):
+    return SessionReport(report_id=report_id, serial=report['Serial'], sec=int(report['Sec']),
+                         session_id=int(report['Session ID']), hardware_limit=int(report['Curr HW']),
+                         energy_start=int(report['E start']), energy_present=int(report['E pres']),
+                         started_seconds=int(report['started[s]']), ended_seconds=int(report['ended[s]']),
+                         started=report['started'], ended=report['ended'], reason=int(report['reason']),
+                         time_q=str(report['timeQ']), rfid_tag=report['RFID tag'], rfid_class=report['RFID class'])
+
+
+def decode(data):
+    """
+    Parses a datagram received from a wallbox into a report record or a Push.
+    Returns None for anything else (such as the reply to "i"), raises InvalidReport for malformed reports.
+    """
+    try:
+        message = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(message, dict):
+        return None
+    raw_id = message.get('ID')
+    if raw_id is None:
+        if len(message) != 1:
+            return None
+        (name, value), = message.items()
+        try:
+            return Push(name, int(value))
+        except (ValueError, TypeError, OverflowError):
+            return None
+    try:
+        report_id = int(raw_id)
+        if report_id == 1:
+            return decode_system(message)
+        if report_id == 2:
+            return decode_config(message)
+        if report_id == 3:
+            return decode_charging(message)
+        if report_id >= 100:
+            return decode_session(report_id, message)
+    except (ValueError, KeyError, TypeError, OverflowError):
+        # OverflowError: JSON allows numbers like 1e999, which become infinite floats
+        pass
+    raise InvalidReport(raw_id, data)
@@ -1,9 +1,14 @@
 import datetime
+from types import SimpleNamespace
+
 from django.utils import timezone
 
-from rest_framework import serializers
+from rest_framework import renderers, serializers
+
+from api.models import ChargeSession, RFIDToken, Wallbox, PowerRollup
+
 
-from api.models import ChargeSession, RFIDToken, Wallbox
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
 
 
 class RFIDSerializer(serializers.ModelSerializer):
@@ -30,3 +35,123 @@ class WallboxSerializer(serializers.ModelSerializer):
 
     def get_uptime(self, obj):
         return int(obj.uptime.total_seconds()) + int((timezone.now() - obj.lastUpdated).total_seconds())
+
+
+class PowerRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PowerRollup
+        fields = ['start', 'resolution', 'samples', 'powerAvg', 'powerMin', 'powerMax']
+
+
+class EnergySerializer(serializers.Serializer):
+    period = serializers.DateField()
+    # Only present if grouped by
+    token = serializers.IntegerField(required=False)
+    wallbox = serializers.CharField(required=False)
+    sessions = serializers.IntegerField(source='sessionCount')
+    chargedEnergy = serializers.DecimalField(max_digits=15, decimal_places=1, source='energy')
+
+
+class ValuesSerializer:
+    """
+    Produces the same representation as the given (model) serializer, but from the rows of a values() queryset
+    instead of model instances. Related rows are fetched by the same query (through a join), and the overhead
+    of creating and serializing a model instance per row is avoided.
+    Use values_fields for the values() call.
+    """
+
+    def __init__(self, serializer):
+        self.values_fields = []
+        self.plan = self._plan(serializer, "")
+
+    def _plan(self, serializer, prefix):
+        plan = []
+        method_fields = False
+        for field in serializer.fields.values():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                method_fields = True
+                plan.append((field.field_name, prefix, field))
+                continue
+            key = prefix + field.source
+            self.values_fields.append(key)
+            if isinstance(field, serializers.BaseSerializer):
+                # Nested serializer of a foreign key, the key itself tells whether there is a related row
+                plan.append((field.field_name, key, self._plan(field, key + "__")))
+            elif isinstance(field, serializers.RelatedField):
+                # Primary keys are represented as they are
+                plan.append((field.field_name, key, None))
+            else:
+                plan.append((field.field_name, key, field))
+        if method_fields:
+            # Methods get the whole row as object, as if it was a model instance
+            self.values_fields.extend(prefix + field.name for field in serializer.Meta.model._meta.concrete_fields
+                                      if prefix + field.name not in self.values_fields)
+        return plan
+
+    def _represent(self, plan, row):
+        result = {}
+        for name, key, field in plan:
+            if isinstance(field, serializers.SerializerMethodField):
+                # The key is the prefix of the columns of the row's object
+                columns = {column[len(key):]: value for column, value in row.items()
+                           if column.startswith(key) and "__" not in column[len(key):]}
+                result[name] = field.to_representation(SimpleNamespace(**columns))
+                continue
+            value = row[key]
+            if value is None:
+                result[name] = None
+            elif field is None:
+                result[name] = value
+            elif isinstance(field, list):
+                result[name] = self._represent(field, row)
+            else:
+                result[name] = field.to_representation(value)
+        return result
+
+    def represent(self, rows):
+        return [self._represent(self.plan, row) for row in rows]
+
+    def _compact(self, entry, row):
+        name, key, field = entry
+        if isinstance(field, serializers.DateTimeField) and row[key] is not None:
+            return (row[key] - EPOCH) // datetime.timedelta(milliseconds=1)
+        if isinstance(field, serializers.DecimalField):
+            # Rendered as number
+            return row[key]
+        return self._represent([entry], row)[name]
+
+    def represent_columns(self, rows):
+        """
+        Compact representation of the rows (see ColumnsRenderer): An array of values per field. Related rows and keys
+        are sent once, in a dictionary per field, and referenced by their position in it. Times are milliseconds
+        since the epoch, decimals are numbers.
+        """
+        rows = list(rows)
+        columns = {}
+        dictionaries = {}
+        for entry in self.plan:
+            name, key, field = entry
+            if field is not None and not isinstance(field, list):
+                columns[name] = [self._compact(entry, row) for row in rows]
+                continue
+            positions = {}
+            dictionary = dictionaries[name] = []
+            column = columns[name] = []
+            for row in rows:
+                value = row[key]
+                if value is not None and value not in positions:
+                    positions[value] = len(dictionary)
+                    dictionary.append(value if field is None else self._represent(field, row))
+                column.append(positions.get(value))
+        return {'columns': columns, 'dictionaries': dictionaries}
+
+
+class ColumnsRenderer(renderers.JSONRenderer):
+    """
+    Opt-in compact format of the lists (Accept: application/vnd.wallbox.columns+json, or format=columns), see
+    ValuesSerializer.represent_columns().
+    """
+    media_type = "application/vnd.wallbox.columns+json"
+    format = "columns"
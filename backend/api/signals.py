@@ -0,0 +1,32 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from api.cache import bump_identity_generation, bump_data_generation, SESSIONS, TOKENS
+from api.models import ChargeSession, RFIDToken, Wallbox
+
+
+@receiver(post_save, sender=RFIDToken)
+def token_saved(sender, instance, created, **kwargs):
+    # New tokens can't be cached yet, only edits invalidate
+    if not created:
+        bump_identity_generation()
+
+
+@receiver(post_delete, sender=RFIDToken)
+@receiver(post_delete, sender=Wallbox)
+def identity_deleted(sender, instance, **kwargs):
+    bump_identity_generation()
+
+
+# Bumped once committed, so responses computed in between can't be cached as the new generation
+@receiver(post_save, sender=ChargeSession)
+@receiver(post_delete, sender=ChargeSession)
+def session_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_data_generation(SESSIONS))
+
+
+@receiver(post_save, sender=RFIDToken)
+@receiver(post_delete, sender=RFIDToken)
+def token_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_data_generation(TOKENS))
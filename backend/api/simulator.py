@@ -0,0 +1,206 @@
+import asyncio
+import datetime
+import ipaddress
+import json
+import random
+import time
+from collections import deque
+
+SERIAL_BASE = 90000000
+FIRMWARE = "P30 v 3.10.16 (200713-101501)"
+PRODUCT = "KC-P30-EC240422-E00"
+HISTORY_SIZE = 30
+RFID_TAGS = ["e3f76b8d00000000", "0a1b2c3d00000000", "deadbeef00000000"]
+RFID_CLASS = "01010400000000000000"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.000"
+
+STATE_NOT_READY = 1
+STATE_CHARGING = 3
+PLUG_UNPLUGGED = 1
+PLUG_LOCKED = 7
+
+
+def addresses(base_address, count):
+    return [str(ipaddress.IPv4Address(base_address) + index) for index in range(count)]
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).strftime(TIME_FORMAT)
+
+
+class SimulatedWallbox(asyncio.DatagramProtocol):
+    """
+    Answers requests of the KEBA UDP protocol like a P30 would, and runs through charge sessions
+    (pushing E pres, Plug and State changes to the last peer that talked to it).
+    """
+
+    def __init__(self, index, simulator):
+        self.simulator = simulator
+        self.serial = str(SERIAL_BASE + index)
+        self.transport = None
+        self.peer = None
+        # Pretend the wallbox has been running for a while already
+        self.boot = time.time() - random.randint(3600, 30 * 86400)
+        self.energy_total = random.randint(10000000, 90000000)
+        # Session IDs are only unique per wallbox, so the histories of the simulated wallboxes overlap
+        self.session_id = random.randint(100, 100 + HISTORY_SIZE)
+        self.history = deque(maxlen=HISTORY_SIZE)
+        for session in range(simulator.history):
+            self.history.appendleft(self._finished_session(self.session_id - simulator.history + 1 + session))
+        self.session = None
+        self.charging_until = 0
+        self.idle_until = time.time() + random.uniform(0, simulator.idle_length)
+        self.last_push = 0
+
+    def sec(self, timestamp=None):
+        return int((timestamp or time.time()) - self.boot)
+
+    def _finished_session(self, session_id):
+        ended = time.time() - random.randint(3600, 86400)
+        started = ended - random.randint(600, 4 * 3600)
+        energy = random.randint(10000, 400000)
+        return {"Session ID": session_id, "Curr HW": 16000, "E start": self.energy_total - energy, "E pres": energy,
+                "started[s]": self.sec(started), "ended[s]": self.sec(ended), "started": format_time(started),
+                "ended": format_time(ended), "reason": 1, "timeQ": 3, "RFID tag": random.choice(RFID_TAGS),
+                "RFID class": RFID_CLASS}
+
+    def _empty_session(self):
+        return {"Session ID": -1, "Curr HW": 0, "E start": 0, "E pres": 0, "started[s]": 0, "ended[s]": 0,
+                "started": "0", "ended": "0", "reason": 0, "timeQ": 0, "RFID tag": "0000000000000000",
+                "RFID class": "00000000000000000000"}
+
+    @property
+    def charging(self):
+        return self.session is not None and self.session["ended[s]"] == 0
+
+    def report(self, report_id):
+        sec = self.sec()
+        if report_id == 1:
+            data = {"Product": PRODUCT, "Serial": self.serial, "Firmware": FIRMWARE, "COM-module": 0, "Backend": 0,
+                    "timeQ": 3, "DIP-Sw1": "0x26", "DIP-Sw2": "0x00"}
+        elif report_id == 2:
+            data = {"State": STATE_CHARGING if self.charging else STATE_NOT_READY, "Error1": 0, "Error2": 0,
+                    "Plug": PLUG_LOCKED if self.charging else PLUG_UNPLUGGED, "AuthON": 0, "Authreq": 0,
+                    "Enable sys": 1, "Enable user": 1, "Max curr": 16000, "Max curr %": 1000, "Curr HW": 16000,
+                    "Curr user": 16000, "Curr FS": 0, "Tmo FS": 0, "Curr timer": 0, "Tmo CT": 0, "Setenergy": 0,
+                    "Output": 0, "Input": 0, "X2 phaseSwitch source": 0, "X2 phaseSwitch": 0, "Serial": self.serial}
+        elif report_id == 3:
+            current = random.randint(15800, 16000) if self.charging else 0
+            power = current * 3 * 230 if self.charging else 0
+            data = {"U1": random.randint(228, 234), "U2": random.randint(228, 234), "U3": random.randint(228, 234),
+                    "I1": current, "I2": current, "I3": current, "P": power, "PF": 999 if self.charging else 0,
+                    "E pres": self.session["E pres"] if self.session else 0, "E total": self.energy_total,
+                    "Serial": self.serial}
+        elif report_id == 100:
+            data = dict(self.session) if self.session else self._empty_session()
+            data["Serial"] = self.serial
+        elif 100 < report_id <= 100 + HISTORY_SIZE:
+            position = report_id - 101
+            data = dict(self.history[position]) if position < len(self.history) else self._empty_session()
+            data["Serial"] = self.serial
+        else:
+            return None
+        return json.dumps({"ID": str(report_id), **data, "Sec": sec})
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.peer = addr
+        request = data.decode("utf-8").strip()
+        if request == "i":
+            response = f'"Firmware":"{FIRMWARE}"'
+        elif request.startswith("report ") and request[7:].isdigit():
+            response = self.report(int(request[7:]))
+            if response is None:
+                return
+        else:
+            return
+        self.simulator.requests += 1
+        self.reply(response.encode("utf-8"))
+
+    def reply(self, data):
+        simulator = self.simulator
+        if random.random() < simulator.loss:
+            return
+        copies = 2 if random.random() < simulator.duplicates else 1
+        loop = asyncio.get_running_loop()
+        for _ in range(copies):
+            loop.call_later(simulator.latency * random.uniform(0.5, 1.5), self.send, data, self.peer)
+
+    def send(self, data, addr):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+
+    def push(self, name, value):
+        if self.peer is not None:
+            self.simulator.pushes += 1
+            self.reply(json.dumps({name: value}).encode("utf-8"))
+
+    def tick(self, now):
+        simulator = self.simulator
+        if self.charging:
+            # Charge with roughly 11 kW, E pres is in 0.1 Wh
+            self.session["E pres"] += int(11000 * simulator.tick / 3600 * 10)
+            self.energy_total += int(11000 * simulator.tick / 3600 * 10)
+            if now >= self.charging_until:
+                self.session.update({"ended[s]": self.sec(now), "ended": format_time(now), "reason": 1})
+                self.history.appendleft(dict(self.session))
+                self.idle_until = now + random.uniform(0.5, 1.5) * simulator.idle_length
+                self.push("State", STATE_NOT_READY)
+                self.push("Plug", PLUG_UNPLUGGED)
+            elif now - self.last_push >= simulator.push_interval:
+                self.last_push = now
+                self.push("E pres", self.session["E pres"])
+        elif now >= self.idle_until:
+            self.session_id += 1
+            self.session = {"Session ID": self.session_id, "Curr HW": 16000, "E start": self.energy_total,
+                            "E pres": 0, "started[s]": self.sec(now), "ended[s]": 0, "started": format_time(now),
+                            "ended": "0", "reason": 0, "timeQ": 3, "RFID tag": random.choice(RFID_TAGS),
+                            "RFID class": RFID_CLASS}
+            self.charging_until = now + random.uniform(0.5, 1.5) * simulator.session_length
+            self.last_push = now
+            self.push("Plug", PLUG_LOCKED)
+            self.push("State", STATE_CHARGING)
+
+
+class Simulator:
+    """
+    A fleet of simulated wallboxes. Wallboxes are told apart by their IP address, so every simulated wallbox
+    listens on its own loopback address (starting at base_address), on the wallbox port.
+    """
+
+    def __init__(self, count, base_address="127.0.1.1", port=7090, latency=0.01, loss=0.0, duplicates=0.0,
+                 history=HISTORY_SIZE, session_length=1800, idle_length=600, push_interval=30, tick=1):
+        self.addresses = addresses(base_address, count)
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self.duplicates = duplicates
+        self.history = min(history, HISTORY_SIZE)
+        self.session_length = session_length
+        self.idle_length = idle_length
+        self.push_interval = push_interval
+        self.tick = tick
+        self.wallboxes = []
+        self.requests = 0
+        self.pushes = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for index, address in enumerate(self.addresses):
+            wallbox = SimulatedWallbox(index, self)
+            await loop.create_datagram_endpoint(lambda: wallbox, local_addr=(address, self.port))
+            self.wallboxes.append(wallbox)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.time()
+            for wallbox in self.wallboxes:
+                wallbox.tick(now)
+
+    def close(self):
+        for wallbox in self.wallboxes:
+            if wallbox.transport is not None:
+                wallbox.transport.close()
@@ -0,0 +1,79 @@
+import datetime
+
+from django.db.models import Max
+from django.utils import timezone
+
+from api.models import PowerSample, PowerRollup, Wallbox
+from backend.settings import TELEMETRY_RETENTION_RAW, TELEMETRY_RETENTION
+
+# Every resolution is computed from the next finer one, raw samples being the finest
+ROLLUP_SOURCES = {
+    60: None,
+    900: 60,
+    3600: 900,
+}
+
+
+def bucket_start(timestamp, resolution):
+    epoch = int(timestamp.timestamp())
+    return datetime.datetime.fromtimestamp(epoch - epoch % resolution, tz=datetime.timezone.utc)
+
+
+def rollup(wallbox_id, resolution):
+    """
+    Recomputes all buckets of the given resolution from the latest existing one onwards,
+    so the latest (possibly partial) bucket is completed as new data arrives.
+    Returns the number of buckets written.
+    """
+    since = PowerRollup.objects.filter(wallbox_id=wallbox_id, resolution=resolution).aggregate(Max('start'))['start__max']
+    source_resolution = ROLLUP_SOURCES[resolution]
+    if source_resolution is None:
+        source = PowerSample.objects.filter(wallbox_id=wallbox_id)
+        if since is not None:
+            source = source.filter(timestamp__gte=since)
+        rows = ((timestamp, 1, power, power, power) for timestamp, power in
+                source.order_by('timestamp').values_list('timestamp', 'power').iterator())
+    else:
+        source = PowerRollup.objects.filter(wallbox_id=wallbox_id, resolution=source_resolution)
+        if since is not None:
+            source = source.filter(start__gte=since)
+        rows = source.order_by('start').values_list('start', 'samples', 'powerAvg', 'powerMin', 'powerMax').iterator()
+    buckets = {}
+    for timestamp, samples, power_avg, power_min, power_max in rows:
+        start = bucket_start(timestamp, resolution)
+        bucket = buckets.get(start)
+        if bucket is None:
+            buckets[start] = [samples, power_avg * samples, power_min, power_max]
+        else:
+            bucket[0] += samples
+            bucket[1] += power_avg * samples
+            bucket[2] = min(bucket[2], power_min)
+            bucket[3] = max(bucket[3], power_max)
+    PowerRollup.objects.bulk_create(
+        [PowerRollup(wallbox_id=wallbox_id, resolution=resolution, start=start, samples=samples,
+                     powerAvg=power_sum // samples, powerMin=power_min, powerMax=power_max)
+         for start, (samples, power_sum, power_min, power_max) in buckets.items()],
+        update_conflicts=True,
+        unique_fields=['wallbox', 'resolution', 'start'],
+        update_fields=['samples', 'powerAvg', 'powerMin', 'powerMax'],
+    )
+    return len(buckets)
+
+
+def prune(wallbox_id):
+    now = timezone.now()
+    if TELEMETRY_RETENTION_RAW is not None:
+        PowerSample.objects.filter(
+            wallbox_id=wallbox_id, timestamp__lt=now - datetime.timedelta(days=TELEMETRY_RETENTION_RAW)).delete()
+    for resolution, retention in TELEMETRY_RETENTION.items():
+        if retention is not None:
+            PowerRollup.objects.filter(
+                wallbox_id=wallbox_id, resolution=resolution,
+                start__lt=now - datetime.timedelta(days=retention)).delete()
+
+
+def maintain_telemetry():
+    for wallbox_id in Wallbox.objects.values_list('pk', flat=True):
+        for resolution in ROLLUP_SOURCES:
+            rollup(wallbox_id, resolution)
+        prune(wallbox_id)
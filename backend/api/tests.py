@@ -1,3 +1,896 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import dataclasses
+import datetime
+import json
+import os
+import tempfile
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import asyncudp
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
+from django.urls import resolve
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from knox.models import AuthToken
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from api import export, live, views
+from api.capture import CaptureWriter
+from api.energy import add_to_energy_rollup, rebuild_energy_rollups
+from api.management.commands import wallboxIO
+from api.management.commands.wallboxIO import (LAST_UPDATED_MAX_AGE, DatabaseWriter, HealthReporter, Replayer,
+                                               WallboxCommunicator, WallboxDispatcher, WallboxUnreachable,
+                                               add_charge_session, get_token_sync, get_wallbox_sync, identity_cache,
+                                               persist_reports, refresh_identity_caches, request_key,
+                                               token_identities, wallbox_identities)
+from api.middleware import MetricsMiddleware, count_query, install_query_counter, query_count, request_queries
+from api.models import ChargeSession, EnergyRollup, PowerRollup, PowerSample, RFIDToken, Wallbox
+from api.reports import ChargingReport, ConfigReport, InvalidReport, Push, SessionReport, SystemReport, decode
+from api.serializers import ChargeSessionSerializer, ColumnsRenderer, WallboxSerializer
+from api.simulator import HISTORY_SIZE, Simulator
+from api.telemetry import maintain_telemetry, prune, rollup
+
+NOW = datetime.datetime(2024, 5, 1, 12, 0, tzinfo=datetime.timezone.utc)
+# Keep the tests away from the shared file cache
+TEST_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+WALLBOX_IO_LOGGER = "api.management.commands.wallboxIO"
+
+
+def session_report(serial, session_id, energy=12345, started="2024-04-30 08:00:00.000",
+                   ended="2024-04-30 10:00:00.000"):
+    # A finished session of the history with a synchronized clock
+    return SessionReport(report_id=101, serial=serial, sec=100000, session_id=session_id, hardware_limit=16000,
+                         energy_start=1000000, energy_present=energy, started_seconds=90000, ended_seconds=97200,
+                         started=started, ended=ended, reason=1, time_q="3", rfid_tag="e3f76b8d00000000",
+                         rfid_class="01010400000000000000")
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ListEndpointTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("test")
+        tokens = [RFIDToken.objects.create(tokenID=f"{i:016x}", tokenClass="01010400000000000000",
+                                           name=f"Card {i}" if i % 2 else "") for i in range(3)]
+        wallboxes = [Wallbox.objects.create(serial="90000001", currentToken=tokens[0], currentSessionID=20,
+                                            currentSession=Decimal("1.5"), currentStartTime=NOW),
+                     Wallbox.objects.create(serial="90000002")]
+        for session_id in range(1, 21):
+            started = NOW - datetime.timedelta(days=session_id)
+            ChargeSession.objects.create(sessionID=session_id, hardwareCurrentLimit=16000,
+                                         energyMeterAtStart=Decimal("1234.5") * session_id,
+                                         chargedEnergy=Decimal("10.1") * session_id, started=started,
+                                         ended=started + datetime.timedelta(hours=2),
+                                         token=tokens[session_id % 3], wallboxSerial=wallboxes[session_id % 2])
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def render(self, serializer_class, queryset):
+        return JSONRenderer().render(serializer_class(queryset, many=True).data)
+
+    def test_list_view_names(self):
+        # Metrics are labelled by view name
+        self.assertEqual(resolve("/api/charge_sessions/list/").view_name, "api.views.ChargeSessionList")
+        self.assertEqual(resolve("/api/wallboxes/list/").view_name, "api.views.WallboxList")
+        self.assertEqual(resolve("/api/tokens/list/").view_name, "api.views.RFIDTokenList")
+
+    def test_list_requires_authentication(self):
+        response = APIClient().get("/api/wallboxes/list/")
+        self.assertEqual(response.status_code, 401)
+
+    def test_session_list_query_count(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/charge_sessions/list/")
+        self.assertEqual(len(response.json()), 20)
+
+    def test_session_list_page_query_count(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/charge_sessions/list/", {"page_size": 5, "ordering": "-started"})
+        self.assertEqual(len(response.json()["results"]), 5)
+
+    def test_session_list_columns(self):
+        sessions = self.client.get("/api/charge_sessions/list/").json()
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/charge_sessions/list/", HTTP_ACCEPT=ColumnsRenderer.media_type)
+        self.assertEqual(response["Content-Type"], ColumnsRenderer.media_type)
+        columns = response.json()["columns"]
+        dictionaries = response.json()["dictionaries"]
+        self.assertEqual(len(dictionaries["token"]), 3)
+        self.assertEqual(len(dictionaries["wallboxSerial"]), 2)
+        for i, session in enumerate(sessions):
+            self.assertEqual(columns["sessionID"][i], session["sessionID"])
+            self.assertEqual(dictionaries["token"][columns["token"][i]], session["token"])
+            self.assertEqual(dictionaries["wallboxSerial"][columns["wallboxSerial"][i]], session["wallboxSerial"])
+            self.assertEqual(Decimal(str(columns["chargedEnergy"][i])), Decimal(session["chargedEnergy"]))
+            self.assertEqual(datetime.datetime.fromtimestamp(columns["started"][i] / 1000, datetime.timezone.utc),
+                             datetime.datetime.fromisoformat(session["started"]))
+
+    def test_wallbox_list_query_count(self):
+        # The list is validated by an aggregate query first (see ConditionalListMixin)
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/wallboxes/list/")
+        self.assertEqual(len(response.json()), 2)
+
+    def test_session_list_matches_serializer(self):
+        response = self.client.get("/api/charge_sessions/list/")
+        expected = self.render(ChargeSessionSerializer, ChargeSession.objects.order_by('-sessionID', '-id'))
+        self.assertEqual(response.content, expected)
+
+    def test_wallbox_list_matches_serializer(self):
+        # The uptime depends on the current time
+        with mock.patch.object(timezone, "now", return_value=NOW):
+            response = self.client.get("/api/wallboxes/list/")
+            expected = self.render(WallboxSerializer, Wallbox.objects.all())
+        self.assertEqual(response.content, expected)
+
+    def test_session_list_not_modified(self):
+        etag = self.client.get("/api/charge_sessions/list/")["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/charge_sessions/list/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get("/api/charge_sessions/list/", {"page_size": 5}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_session_list_modified(self):
+        response = self.client.get("/api/charge_sessions/list/")
+        session = ChargeSession.objects.get(sessionID=20)
+        session.pk = None
+        session.sessionID = 21
+        with self.captureOnCommitCallbacks(execute=True):
+            session.save()
+        response = self.client.get("/api/charge_sessions/list/", HTTP_IF_NONE_MATCH=response["ETag"],
+                                   HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 21)
+
+    def test_wallbox_list_modified(self):
+        etag = self.client.get("/api/wallboxes/list/")["ETag"]
+        self.assertEqual(self.client.get("/api/wallboxes/list/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Wallbox.objects.get(pk="90000002").save(update_fields=["lastUpdated"])
+        self.assertEqual(self.client.get("/api/wallboxes/list/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_token_list_modified(self):
+        etag = self.client.get("/api/tokens/list/")["ETag"]
+        self.assertEqual(self.client.get("/api/tokens/list/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        token = RFIDToken.objects.get(name="Card 1")
+        token.name = "Renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            token.save()
+        self.assertEqual(self.client.get("/api/tokens/list/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_session_list_cached(self):
+        response = self.client.get("/api/charge_sessions/list/", {"page_size": 5, "tokens": "1,2"})
+        with self.assertNumQueries(0):
+            cached = self.client.get("/api/charge_sessions/list/", {"tokens": "1,2", "page_size": 5})
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached["Content-Type"], response["Content-Type"])
+        token = RFIDToken.objects.get(name="Card 1")
+        token.name = "Renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            token.save()
+        response = self.client.get("/api/charge_sessions/list/", {"page_size": 5, "tokens": "1,2"})
+        self.assertIn(b"Renamed", response.content)
+
+    async def test_export_streams_asynchronously(self):
+        token = (await sync_to_async(AuthToken.objects.create)(self.user))[1]
+        with mock.patch("api.views.EXPORT_CHUNK_SIZE", 5), mock.patch.object(export, "EXPORT_CHUNK_SIZE", 5), \
+                mock.patch.object(export, "export_values", wraps=export.export_values) as export_values:
+            response = await AsyncClient().get("/api/charge_sessions/export/", {"format": "ndjson"},
+                                               headers={"Authorization": f"Token {token}"})
+            self.assertTrue(response.is_async)
+            chunks = aiter(response.streaming_content)
+            first = await anext(chunks)
+            # Only the first chunk has been read from the database
+            self.assertEqual(len(first.splitlines()), 5)
+            self.assertEqual(export_values.call_count, 5)
+            rest = [chunk async for chunk in chunks]
+        self.assertEqual(len(b"".join([first] + rest).splitlines()), 20)
+
+    def test_export_streams_under_wsgi(self):
+        with mock.patch("api.views.EXPORT_CHUNK_SIZE", 5), mock.patch.object(export, "EXPORT_CHUNK_SIZE", 5), \
+                mock.patch.object(export, "export_values", wraps=export.export_values) as export_values:
+            response = self.client.get("/api/charge_sessions/export/")
+            self.assertFalse(response.is_async)
+            chunks = iter(response.streaming_content)
+            first = next(chunks)
+            # Header and the first sessions, nothing more read yet
+            self.assertEqual(len(first.decode("utf-8-sig").splitlines()), 6)
+            self.assertEqual(export_values.call_count, 5)
+            rest = list(chunks)
+        self.assertEqual(len(b"".join([first] + rest).splitlines()), 21)
+        response = self.client.get("/api/charge_sessions/export/", {"not_before": "2030-01-01"})
+        self.assertEqual(b"".join(response.streaming_content).decode("utf-8-sig").splitlines(),
+                         ["RFID Token;Beginn;Ende;Geladene Energie (Wh);Seriennummer der Wallbox;Modell"])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class EnergyAggregateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("test")
+        cls.tokens = [RFIDToken.objects.create(tokenID=f"{i:016x}", tokenClass="01010400000000000000")
+                      for i in range(2)]
+        wallboxes = [Wallbox.objects.create(serial=f"9000000{i}") for i in range(2)]
+        for session_id in range(1, 41):
+            # Some sessions start shortly before midnight (local time) at the end of a month
+            started = NOW - datetime.timedelta(days=3 * session_id, hours=12) + datetime.timedelta(minutes=session_id)
+            session = ChargeSession.objects.create(sessionID=session_id, hardwareCurrentLimit=16000,
+                                                   energyMeterAtStart=Decimal(0),
+                                                   chargedEnergy=Decimal("7.3") * session_id, started=started,
+                                                   ended=started, token=cls.tokens[session_id % 2],
+                                                   wallboxSerial=wallboxes[session_id % 3 % 2])
+            add_to_energy_rollup(session)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_incremental_matches_rebuild(self):
+        incremental = set(EnergyRollup.objects.values_list('day', 'token', 'wallbox', 'sessions', 'chargedEnergy'))
+        rebuild_energy_rollups()
+        rebuilt = set(EnergyRollup.objects.values_list('day', 'token', 'wallbox', 'sessions', 'chargedEnergy'))
+        self.assertEqual(incremental, rebuilt)
+
+    def test_monthly_per_token(self):
+        expected = {}
+        for session in ChargeSession.objects.all():
+            key = (timezone.localdate(session.started).replace(day=1).isoformat(), session.token_id)
+            sessions, energy = expected.get(key, (0, Decimal(0)))
+            expected[key] = (sessions + 1, energy + session.chargedEnergy)
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/charge_sessions/energy/", {"group_by": "token"})
+        self.assertEqual({(row["period"], row["token"]): (row["sessions"], Decimal(row["chargedEnergy"]))
+                          for row in response.json()}, expected)
+
+    def test_filters(self):
+        response = self.client.get("/api/charge_sessions/energy/", {"period": "year", "tokens": self.tokens[0].pk,
+                                                                    "not_before": "01.04.2024"})
+        sessions = ChargeSession.objects.filter(token=self.tokens[0], started__date__gte=datetime.date(2024, 4, 1))
+        self.assertEqual(response.json(), [{"period": "2024-01-01", "sessions": sessions.count(),
+                                            "chargedEnergy": str(sum(s.chargedEnergy for s in sessions))}])
+        response = self.client.get("/api/charge_sessions/energy/", {"group_by": "session"})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class IngestTests(TestCase):
+    def setUp(self):
+        # The wallboxes and tokens cached by earlier tests are gone
+        wallbox_identities.clear()
+        token_identities.clear()
+
+    def test_session_ids_per_wallbox(self):
+        add_charge_session(session_report("90000001", 7), NOW.timestamp())
+        add_charge_session(session_report("90000002", 7, energy=20000), NOW.timestamp())
+        # Recorded again (e.g. when replaying a capture)
+        add_charge_session(session_report("90000001", 7), NOW.timestamp())
+        self.assertEqual(sorted(ChargeSession.objects.values_list('wallboxSerial', 'sessionID', 'chargedEnergy')),
+                         [("90000001", 7, Decimal("1234.5")), ("90000002", 7, Decimal("2000.0"))])
+        self.assertEqual(sum(EnergyRollup.objects.values_list('sessions', flat=True)), 2)
+
+    def test_recorded_again_with_new_data(self):
+        add_charge_session(session_report("90000001", 7), NOW.timestamp())
+        add_charge_session(session_report("90000001", 8), NOW.timestamp())
+        add_charge_session(session_report("90000001", 7, energy=20000), NOW.timestamp())
+        self.assertEqual(list(EnergyRollup.objects.values_list('sessions', 'chargedEnergy')), [(2, Decimal("3234.5"))])
+        # Moved to another day
+        add_charge_session(session_report("90000001", 8, started="2024-04-29 08:00:00.000",
+                                          ended="2024-04-29 10:00:00.000"), NOW.timestamp())
+        rollups = list(EnergyRollup.objects.order_by('day').values_list('day', 'sessions', 'chargedEnergy'))
+        self.assertEqual(rollups, [(datetime.date(2024, 4, 29), 1, Decimal("1234.5")),
+                                   (datetime.date(2024, 4, 30), 1, Decimal("2000.0"))])
+        add_charge_session(session_report("90000001", 8), NOW.timestamp())
+        self.assertEqual(list(EnergyRollup.objects.values_list('day', 'sessions', 'chargedEnergy')),
+                         [(datetime.date(2024, 4, 30), 2, Decimal("3234.5"))])
+        rebuild_energy_rollups()
+        self.assertEqual(list(EnergyRollup.objects.values_list('day', 'sessions', 'chargedEnergy')),
+                         [(datetime.date(2024, 4, 30), 2, Decimal("3234.5"))])
+
+    async def test_history_of_overlapping_wallboxes(self):
+        # Both wallboxes hand out session IDs 1 to 5, those of the first one are recorded already
+        for session_id in range(1, 6):
+            await sync_to_async(add_charge_session)(session_report("90000001", session_id), NOW.timestamp())
+        communicator = WallboxCommunicator(None, ("192.0.2.2", 7090), DatabaseWriter())
+
+        async def fetch_history(positions):
+            communicator.received.update({str(101 + position): NOW.timestamp() for position in positions})
+            return {position: dataclasses.replace(session_report("90000002", 5 - position), report_id=101 + position)
+                    for position in positions}
+
+        with mock.patch.object(communicator, "_fetch_history", fetch_history), self.assertLogs(WALLBOX_IO_LOGGER):
+            await communicator.search_for_new_sessions(session_report("90000002", 6))
+        self.assertEqual(set(communicator.writer.sessions), {("90000002", session_id) for session_id in range(1, 6)})
+
+    def test_identity_caches_invalidated(self):
+        refresh_identity_caches()
+        hits = identity_cache.values[(("cache", "wallbox"), ("result", "hit"))]
+        wallbox = get_wallbox_sync("90000001")
+        token = get_token_sync("e3f76b8d00000000", "01010400000000000000")
+        self.assertIs(get_wallbox_sync("90000001"), wallbox)
+        self.assertEqual(identity_cache.values[(("cache", "wallbox"), ("result", "hit"))], hits + 1)
+        # Edited in the admin
+        token.name = "Company car"
+        token.save()
+        refresh_identity_caches()
+        self.assertEqual((len(wallbox_identities), len(token_identities)), (0, 0))
+        self.assertEqual(get_token_sync("e3f76b8d00000000", "01010400000000000000").name, "Company car")
+        get_wallbox_sync("90000001").delete()
+        refresh_identity_caches()
+        self.assertEqual((len(wallbox_identities), len(token_identities)), (0, 0))
+        self.assertIsNotNone(get_wallbox_sync("90000001").pk)
+        self.assertEqual(Wallbox.objects.count(), 1)
+
+    def test_queue_drops_telemetry_only(self):
+        writer = DatabaseWriter(size=3)
+        address = ("192.0.2.1", 7090)
+        current_session = dataclasses.replace(session_report("90000001", 3), report_id=100)
+        writer.submit(address, charging_report("90000001"), NOW.timestamp())
+        writer.submit(address, Push("State", 3), NOW.timestamp())
+        writer.submit(address, Push("E pres", 100), NOW.timestamp())
+        writer.submit(address, current_session, NOW.timestamp())
+        writer.submit(address, Push("Plug", 7), NOW.timestamp())
+        # Without telemetry left to drop, the queue grows beyond its size
+        writer.submit(address, Push("State", 2), NOW.timestamp())
+        self.assertEqual([update for queued, address, received, update in writer.updates],
+                         [Push("State", 3), current_session, Push("Plug", 7), Push("State", 2)])
+
+    async def test_push_carries_receive_time(self):
+        communicator = WallboxCommunicator(None, ("192.0.2.1", 7090), DatabaseWriter())
+        communicator.last_success = NOW.timestamp()
+        communicator.datagram_received(b'{"E pres": 1234}', NOW.timestamp())
+        await communicator.receive_status(1)
+        (queued, address, received, push), = communicator.writer.updates
+        self.assertEqual((address, received, push.value), (("192.0.2.1", 7090), NOW.timestamp(), 1234))
+
+
+class FakeSocket:
+    # Stands in for the UDP socket of the dispatcher
+    def __init__(self):
+        self.sent = []
+        self.datagrams = asyncio.Queue()
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+    async def recvfrom(self):
+        return await self.datagrams.get()
+
+
+CONFIG_REPLY = b'{"ID": "2", "Serial": "90000001", "Sec": 100000, "State": 2, "Plug": 1}'
+
+
+class DispatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.sock = FakeSocket()
+        self.dispatcher = WallboxDispatcher(self.sock)
+        self.communicator = WallboxCommunicator(self.sock, ("192.0.2.1", 7090), DatabaseWriter())
+        self.dispatcher.register(self.communicator)
+
+    @contextlib.asynccontextmanager
+    async def dispatching(self):
+        task = asyncio.create_task(self.dispatcher.run())
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    async def receive(self, data, addr=("192.0.2.1", 7090)):
+        self.sock.datagrams.put_nowait((data, addr))
+        # Let the dispatcher route it
+        await asyncio.sleep(0.01)
+
+    async def test_late_reply(self):
+        async with self.dispatching():
+            with mock.patch.object(wallboxIO, "RESPONSE_TIMEOUT", 0.05), self.assertLogs(WALLBOX_IO_LOGGER):
+                request = asyncio.create_task(self.communicator._send(b"report 2"))
+                await asyncio.sleep(0.08)
+                # The reply to the first attempt answers the resent request
+                await self.receive(CONFIG_REPLY)
+                self.assertEqual((await request).state, 2)
+            self.assertEqual(len(self.sock.sent), 2)
+            with mock.patch.object(wallboxIO, "RESPONSE_TIMEOUT", 0.01), mock.patch.object(wallboxIO, "MIN_WAIT", 0), \
+                    self.assertLogs(WALLBOX_IO_LOGGER), self.assertRaises(WallboxUnreachable):
+                await self.communicator._send(b"report 2")
+            # Nobody waits for it anymore
+            with self.assertLogs(WALLBOX_IO_LOGGER, "DEBUG") as logs:
+                await self.receive(CONFIG_REPLY)
+            self.assertIn("late_reply", logs.output[0])
+            self.assertEqual(self.communicator.pending, {})
+
+    async def test_duplicate_reply(self):
+        async with self.dispatching():
+            request = asyncio.create_task(self.communicator._send(b"report 2"))
+            await asyncio.sleep(0)
+            await self.receive(CONFIG_REPLY)
+            with self.assertLogs(WALLBOX_IO_LOGGER, "DEBUG") as logs:
+                await self.receive(CONFIG_REPLY)
+            self.assertIn("late_reply", logs.output[0])
+            self.assertEqual((await request).state, 2)
+            self.assertEqual(self.communicator.pending, {})
+            self.assertTrue(self.communicator.pushes.empty())
+
+    async def test_unknown_source(self):
+        async with self.dispatching():
+            request = asyncio.create_task(self.communicator._send(b"report 2"))
+            await asyncio.sleep(0)
+            with self.assertLogs(WALLBOX_IO_LOGGER, "WARNING") as logs:
+                await self.receive(CONFIG_REPLY, ("192.0.2.99", 7090))
+            self.assertIn("unauthorized_packet address=192.0.2.99:7090", logs.output[0])
+            self.assertFalse(request.done())
+            await self.receive(CONFIG_REPLY)
+            self.assertEqual((await request).state, 2)
+
+    async def test_unknown_push_is_no_buildup_reply(self):
+        async with self.dispatching():
+            request = asyncio.create_task(self.communicator._send(b"i"))
+            await asyncio.sleep(0)
+            with self.assertLogs(WALLBOX_IO_LOGGER, "WARNING"):
+                await self.receive(b'{"Setenergy": 1}')
+            self.assertFalse(request.done())
+            await self.receive(b'"Firmware":"P30 v 3.10.16 (200713-101501)"\n')
+            self.assertEqual(await request, '"Firmware":"P30 v 3.10.16 (200713-101501)"\n')
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return NOW.timestamp() + self.now
+
+
+class Stop(Exception):
+    pass
+
+
+class SchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.communicator = WallboxCommunicator(None, ("192.0.2.1", 7090), DatabaseWriter())
+        # (time since the start, requested reports) of every poll
+        self.polls = []
+
+    def run_polls(self, count, failing=(), jitter=()):
+        jitter = list(jitter)
+
+        async def poll(reports):
+            self.polls.append((self.clock.now - 1000, sorted(int(request_key(report)) for report in reports)))
+            if len(self.polls) == count:
+                raise Stop()
+            if len(self.polls) in failing:
+                raise WallboxUnreachable()
+
+        async def receive_status(timeout):
+            # Nothing pushed, the time passes at once
+            self.clock.now += timeout
+
+        def uniform(a, b):
+            return jitter.pop(0) if jitter else (a + b) / 2
+
+        with mock.patch.object(wallboxIO, "time", self.clock), mock.patch("random.uniform", uniform), \
+                mock.patch.object(self.communicator, "poll", poll), \
+                mock.patch.object(self.communicator, "receive_status", receive_status), \
+                self.assertLogs(WALLBOX_IO_LOGGER, "DEBUG"), self.assertRaises(Stop):
+            asyncio.run(self.communicator.run())
+
+    def test_schedule_per_report(self):
+        self.communicator.last_state = 3
+        self.run_polls(8)
+        # Charging: report 3 every 10 seconds, report 100 every minute, 2 every 10 minutes, 1 hourly
+        self.assertEqual(self.polls, [(0, [1, 2, 3, 100]), (10, [3]), (20, [3]), (30, [3]), (40, [3]), (50, [3]),
+                                      (60, [3, 100]), (70, [3])])
+
+    def test_schedule_idle(self):
+        self.run_polls(3)
+        self.assertEqual(self.polls, [(0, [1, 2, 3, 100]), (3600, [1, 2, 3, 100]), (7200, [1, 2, 3, 100])])
+
+    def test_coalesce_due_reports(self):
+        self.communicator.last_state = 3
+        # Report 100 comes due at 57 seconds, report 3 (due at 60) goes along
+        self.run_polls(8, jitter=[1, 1, 1, 0.95])
+        self.assertEqual(self.polls[-3:], [(50, [3]), (57, [3, 100]), (67, [3])])
+
+    def test_backoff(self):
+        self.run_polls(12, failing=[*range(2, 10), 11])
+        times = [at for at, reports in self.polls]
+        delays = [later - earlier for earlier, later in zip(times, times[1:])]
+        # Doubles from 10 seconds up to 15 minutes (randomly shortened by up to half, by a quarter here), a successful
+        # poll starts over
+        self.assertEqual(delays, [3600, 7.5, 15, 30, 60, 120, 240, 480, 675, 3600, 7.5])
+        self.assertEqual([reports for at, reports in self.polls], [[1, 2, 3, 100]] * 12)
+
+
+class HealthReporterTests(SimpleTestCase):
+    def setUp(self):
+        self.communicators = [WallboxCommunicator(None, (ip, 7090), DatabaseWriter())
+                              for ip in ("192.0.2.1", "192.0.2.2")]
+        # Status of the health check endpoint, None if it can't be reached
+        self.status = 200
+
+    def report(self, reporter, successes):
+        # Returns the notified URLs
+        for communicator, last_success in zip(self.communicators, successes):
+            communicator.last_success = last_success
+        requested = []
+
+        def get(url):
+            if self.status is None:
+                raise ConnectionRefusedError("Connection refused")
+            requested.append(url)
+            return self.status
+
+        with mock.patch.object(reporter, "_get", get):
+            asyncio.run(reporter.report())
+        return requested
+
+    def test_fleet(self):
+        url = "https://hc.example/ping/fleet"
+        reporter = HealthReporter(url, self.communicators)
+        # Not polled yet
+        self.assertEqual(self.report(reporter, [None, None]), [])
+        # Healthy
+        self.assertEqual(self.report(reporter, [100, 101]), [url])
+        self.assertEqual(self.report(reporter, [110, 111]), [url])
+        # Degraded: the fleet is only reported while every wallbox was polled since the last report (at 110)
+        self.assertEqual(self.report(reporter, [120, 111]), [url])
+        self.assertEqual(self.report(reporter, [130, 111]), [])
+        # Unreachable
+        self.assertEqual(self.report(reporter, [130, 111]), [])
+        self.assertEqual(reporter.last_reported, {url: 111})
+        # Recovered
+        self.assertEqual(self.report(reporter, [140, 141]), [url])
+
+    def test_per_wallbox(self):
+        reporter = HealthReporter("https://hc.example/ping/{wallbox}", self.communicators)
+        first, second = "https://hc.example/ping/192.0.2.1", "https://hc.example/ping/192.0.2.2"
+        self.assertEqual(self.report(reporter, [100, 101]), [first, second])
+        # Degraded: the second wallbox is no longer polled
+        self.assertEqual(self.report(reporter, [110, 101]), [first])
+        # Unreachable
+        self.assertEqual(self.report(reporter, [110, 101]), [])
+        self.assertEqual(self.report(reporter, [110, 121]), [second])
+        self.assertEqual(reporter.last_reported, {first: 110, second: 121})
+
+    def test_failing_endpoint(self):
+        url = "https://hc.example/ping/fleet"
+        reporter = HealthReporter(url, self.communicators)
+        self.status = None
+        with self.assertLogs(WALLBOX_IO_LOGGER, "WARNING") as logs:
+            self.assertEqual(self.report(reporter, [100, 101]), [])
+        self.assertIn("healthcheck_failed", logs.output[0])
+        # Not reported, so it is tried again
+        self.status = 503
+        with self.assertLogs(WALLBOX_IO_LOGGER, "WARNING") as logs:
+            self.assertEqual(self.report(reporter, [100, 101]), [url])
+        self.assertIn("healthcheck_status url=https://hc.example/ping/fleet status=503", logs.output[0])
+        self.assertEqual(self.report(reporter, [100, 101]), [])
+
+
+SYSTEM_REPORT = {"ID": "1", "Product": "KC-P30-EC240422-E00", "Serial": "90000001",
+                 "Firmware": "P30 v 3.10.16 (200713-101501)", "timeQ": 3, "Sec": 100000}
+
+
+class DecodeTests(SimpleTestCase):
+    def decode(self, message):
+        return decode(json.dumps(message).encode())
+
+    def test_reports(self):
+        self.assertEqual(self.decode(SYSTEM_REPORT),
+                         SystemReport(serial="90000001", sec=100000, product="KC-P30-EC240422-E00",
+                                      firmware="P30 v 3.10.16 (200713-101501)", time_q=3))
+        self.assertEqual(self.decode({"E pres": 1234}), Push("E pres", 1234))
+
+    def test_unknown_id(self):
+        for report_id in ("4", "99", "report", None, [1]):
+            with self.subTest(report_id=report_id):
+                message = dict(SYSTEM_REPORT, ID=report_id)
+                if report_id is None:
+                    # Not a report, and too many values for a push
+                    self.assertIsNone(self.decode(message))
+                else:
+                    with self.assertRaises(InvalidReport):
+                        self.decode(message)
+
+    def test_missing_field(self):
+        for field in ("Serial", "Sec", "timeQ"):
+            with self.subTest(field=field):
+                message = dict(SYSTEM_REPORT)
+                del message[field]
+                with self.assertRaises(InvalidReport) as error:
+                    self.decode(message)
+                self.assertEqual(error.exception.report_id, "1")
+
+    def test_wrong_type(self):
+        for value in ("soon", None, [100000], {"Sec": 1}):
+            with self.subTest(value=value), self.assertRaises(InvalidReport):
+                self.decode(dict(SYSTEM_REPORT, Sec=value))
+        with self.assertRaises(InvalidReport):
+            decode(b'{"ID": "1", "Serial": "90000001", "Sec": 1e999}')
+        for data in (b'{"State": "charging"}', b'{"State": null}', b'{"E pres": 1e999}'):
+            with self.subTest(data=data):
+                self.assertIsNone(decode(data))
+
+    def test_not_json(self):
+        for data in (b"", b"TCH-OK :done", b'{"ID": "1", ', b"\xff\xfe\x00", b"[1, 2]", b"42"):
+            with self.subTest(data=data):
+                self.assertIsNone(decode(data))
+
+    async def test_malformed_datagrams_are_rejected(self):
+        communicator = WallboxCommunicator(FakeSocket(), ("192.0.2.1", 7090), DatabaseWriter())
+        request = asyncio.create_task(communicator._send(b"report 1"))
+        await asyncio.sleep(0)
+        malformed = [dict(SYSTEM_REPORT, ID="4"), dict(SYSTEM_REPORT, Sec="soon"), {"ID": "1", "Sec": 1e999}]
+        with self.assertLogs(WALLBOX_IO_LOGGER, "WARNING") as logs:
+            for message in malformed:
+                communicator.datagram_received(json.dumps(message).encode(), NOW.timestamp())
+            communicator.datagram_received(b"\xff\xfe\x00", NOW.timestamp())
+            communicator.datagram_received(b'{"E pres": 1e999}', NOW.timestamp())
+            # Still waiting for a valid reply
+            self.assertFalse(request.done())
+            communicator.datagram_received(json.dumps(SYSTEM_REPORT).encode(), NOW.timestamp())
+            self.assertEqual((await request).serial, "90000001")
+        self.assertEqual([record.getMessage().split()[0] for record in logs.records],
+                         ["invalid_reply"] * 3 + ["invalid_push"] * 2)
+        # Invalid pushes make the scheduler probe the wallbox
+        self.assertEqual([communicator.pushes.get_nowait(), communicator.pushes.get_nowait()],
+                         [(NOW.timestamp(), None)] * 2)
+
+
+def charging_report(serial):
+    return ChargingReport(serial=serial, sec=100000, power=11000000, power_factor=999, energy_present=12345,
+                          energy_total=2000000, voltage1=230, voltage2=230, voltage3=230, current1=16000,
+                          current2=16000, current3=16000)
+
+
+def config_report(serial, sec=100000, state=2):
+    return ConfigReport(serial=serial, sec=sec, state=state, plug=1)
+
+
+class PersistReportsTests(TestCase):
+    def setUp(self):
+        self.wallbox = persist_reports(None, [(NOW.timestamp(), config_report("90000001"))])
+
+    def persist(self, report):
+        # Returns the UPDATE statements
+        with CaptureQueriesContext(connection) as queries:
+            self.wallbox = persist_reports(self.wallbox, [(NOW.timestamp(), report)])
+        return [query["sql"] for query in queries if query["sql"].startswith("UPDATE")]
+
+    def test_unchanged(self):
+        self.assertEqual(self.persist(config_report("90000001")), [])
+        # Within the tolerance of the extrapolated uptime
+        self.assertEqual(self.persist(config_report("90000001", sec=100003)), [])
+
+    def test_changed_field(self):
+        (update,) = self.persist(config_report("90000001", state=3))
+        self.assertIn('"state"', update)
+        self.assertEqual(Wallbox.objects.get().state, Wallbox.state_from_raw(3))
+
+    def test_reboot(self):
+        (update,) = self.persist(config_report("90000001", sec=60))
+        self.assertNotIn('"state"', update)
+        self.assertEqual(Wallbox.objects.get().uptime, datetime.timedelta(seconds=60))
+
+    def test_refresh_last_updated(self):
+        stale = timezone.now() - datetime.timedelta(seconds=LAST_UPDATED_MAX_AGE)
+        Wallbox.objects.update(lastUpdated=stale)
+        self.wallbox.lastUpdated = stale
+        # Unchanged, the uptime went on like the time since the last update
+        (update,) = self.persist(config_report("90000001", sec=100000 + LAST_UPDATED_MAX_AGE))
+        self.assertNotIn('"state"', update)
+        self.assertGreater(Wallbox.objects.get().lastUpdated, stale)
+
+
+# The database writer uses a thread (and connection) of its own
+class WriterTests(TransactionTestCase):
+    def setUp(self):
+        wallbox_identities.clear()
+        token_identities.clear()
+
+    def replay(self, datagrams):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture")
+            capture = CaptureWriter(path)
+            for received, message in datagrams:
+                capture.write(received, ("192.0.2.1", 7090), json.dumps(message).encode())
+            capture.close()
+            with self.assertLogs(WALLBOX_IO_LOGGER):
+                asyncio.run(Replayer().replay(path, 0))
+
+    def test_replay_uses_receive_time(self):
+        received = NOW.timestamp()
+        # The wallbox clock is not synchronized, its times are relative to its uptime ("Sec")
+        session = {"ID": "101", "Serial": "90000001", "Sec": 100000, "Session ID": 7, "Curr HW": 16000,
+                   "E start": 1000000, "E pres": 12345, "started[s]": 90000, "ended[s]": 97200, "started": "0",
+                   "ended": "0", "reason": 1, "timeQ": 2, "RFID tag": "e3f76b8d00000000",
+                   "RFID class": "01010400000000000000"}
+        charging = {"ID": "3", "Serial": "90000001", "Sec": 100000, "P": 11000000, "PF": 999, "E pres": 12345,
+                    "E total": 2000000, "U1": 230, "U2": 230, "U3": 230, "I1": 16000, "I2": 16000, "I3": 16000}
+        self.replay([(received, session), (received, charging)])
+        session = ChargeSession.objects.get()
+        self.assertEqual(session.started, NOW - datetime.timedelta(seconds=10000))
+        self.assertEqual(session.ended, NOW - datetime.timedelta(seconds=2800))
+        self.assertEqual(PowerSample.objects.get().timestamp, NOW)
+
+    def test_writer_survives_malformed_records(self):
+        received = NOW.timestamp()
+
+        async def write():
+            writer = DatabaseWriter()
+            task = asyncio.create_task(writer.run())
+            writer.submit_session(session_report("90000001", 1, started="2024-04-31 08:00:00.000"), received)
+            writer.submit_session(session_report("90000001", 2), received)
+            current_session = session_report("90000001", 3, started="2024-04-31 08:00:00.000")
+            writer.submit(("192.0.2.1", 7090), dataclasses.replace(current_session, report_id=100), received)
+            writer.submit(("192.0.2.1", 7090), charging_report("90000001"), received)
+            # A dead writer never gets idle
+            await asyncio.wait_for(writer.idle.wait(), 10)
+            self.assertFalse(task.done())
+            task.cancel()
+
+        with self.assertLogs(WALLBOX_IO_LOGGER, "ERROR") as logs:
+            asyncio.run(write())
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(list(ChargeSession.objects.values_list('sessionID', flat=True)), [2])
+        self.assertEqual(Wallbox.objects.get().energyMeter, Decimal("200000.0"))
+        self.assertEqual(PowerSample.objects.count(), 1)
+
+    def test_poll_simulated_wallbox(self):
+        polled = asyncio.Event()
+
+        class Communicator(WallboxCommunicator):
+            async def poll(self, reports):
+                await super().poll(reports)
+                polled.set()
+
+        async def serve():
+            # Like the development setup of the README, on ports of our own
+            simulator = Simulator(1, base_address="127.0.0.1", port=0)
+            await simulator.start()
+            (address, port) = simulator.wallboxes[0].transport.get_extra_info("sockname")
+            sock = await asyncudp.create_socket(local_addr=wallboxIO.SOURCE)
+            writer = DatabaseWriter()
+            try:
+                with mock.patch.object(wallboxIO, "WALLBOX_PORT", port):
+                    task = asyncio.create_task(wallboxIO.serve(sock, [address], communicator_class=Communicator,
+                                                               healthcheck_url=None, writer=writer))
+                    await asyncio.wait_for(polled.wait(), 10)
+                await asyncio.wait_for(writer.idle.wait(), 10)
+                task.cancel()
+            finally:
+                sock.close()
+                simulator.close()
+
+        with mock.patch.object(wallboxIO, "SOURCE", ("127.0.0.1", 0)), self.assertLogs(WALLBOX_IO_LOGGER):
+            asyncio.run(serve())
+        wallbox = Wallbox.objects.get()
+        self.assertEqual(wallbox.serial, "90000000")
+        self.assertEqual(ChargeSession.objects.filter(wallboxSerial=wallbox).count(), HISTORY_SIZE)
+        self.assertEqual(PowerSample.objects.filter(wallbox=wallbox).count(), 1)
+
+
+class TelemetryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.wallbox = Wallbox.objects.create(serial="90000001")
+
+    def add_samples(self, *samples):
+        PowerSample.objects.bulk_create(
+            PowerSample(wallbox=self.wallbox, timestamp=timestamp, power=power, powerFactor=999, energy=0,
+                        phase1_voltage=230, phase2_voltage=230, phase3_voltage=230, phase1_current=0,
+                        phase2_current=0, phase3_current=0) for timestamp, power in samples)
+
+    def rollups(self, resolution):
+        return list(PowerRollup.objects.filter(resolution=resolution).order_by('start').values_list(
+            'start', 'samples', 'powerAvg', 'powerMin', 'powerMax'))
+
+    def test_bucket_boundaries(self):
+        # NOW starts a minute (and a quarter of an hour)
+        self.add_samples((NOW - datetime.timedelta(seconds=1), 1000), (NOW, 2000),
+                         (NOW + datetime.timedelta(seconds=59), 4000), (NOW + datetime.timedelta(seconds=60), 8000))
+        self.assertEqual(rollup(self.wallbox.pk, 60), 3)
+        self.assertEqual(self.rollups(60), [(NOW - datetime.timedelta(minutes=1), 1, 1000, 1000, 1000),
+                                            (NOW, 2, 3000, 2000, 4000),
+                                            (NOW + datetime.timedelta(minutes=1), 1, 8000, 8000, 8000)])
+        self.assertEqual(rollup(self.wallbox.pk, 900), 2)
+        self.assertEqual(self.rollups(900), [(NOW - datetime.timedelta(minutes=15), 1, 1000, 1000, 1000),
+                                             (NOW, 3, 14000 // 3, 2000, 8000)])
+
+    def test_rerun_does_not_count_twice(self):
+        self.add_samples((NOW, 2000), (NOW + datetime.timedelta(seconds=70), 4000))
+        rollup(self.wallbox.pk, 60)
+        # Nothing new, only the latest bucket is recomputed
+        self.assertEqual(rollup(self.wallbox.pk, 60), 1)
+        self.add_samples((NOW + datetime.timedelta(seconds=100), 8000))
+        self.assertEqual(rollup(self.wallbox.pk, 60), 1)
+        self.assertEqual(self.rollups(60), [(NOW, 1, 2000, 2000, 2000),
+                                            (NOW + datetime.timedelta(minutes=1), 2, 6000, 4000, 8000)])
+
+    def test_prune(self):
+        self.add_samples((NOW - datetime.timedelta(days=2), 1000), (NOW - datetime.timedelta(hours=23), 2000))
+        rollup(self.wallbox.pk, 60)
+        with mock.patch.object(timezone, "now", return_value=NOW), \
+                mock.patch("api.telemetry.TELEMETRY_RETENTION_RAW", 1), \
+                mock.patch.dict("api.telemetry.TELEMETRY_RETENTION", {60: 2, 900: None, 3600: None}):
+            prune(self.wallbox.pk)
+        self.assertEqual(list(PowerSample.objects.values_list('power', flat=True)), [2000])
+        # The rollup of the pruned sample is kept for longer
+        self.assertEqual(len(self.rollups(60)), 2)
+
+    def test_maintain_telemetry(self):
+        self.add_samples((NOW - datetime.timedelta(days=10), 1000), (NOW, 2000))
+        with mock.patch.object(timezone, "now", return_value=NOW):
+            maintain_telemetry()
+        self.assertEqual(list(PowerSample.objects.values_list('power', flat=True)), [2000])
+        for resolution in (60, 900, 3600):
+            self.assertEqual([row[1:] for row in self.rollups(resolution)],
+                             [(1, 1000, 1000, 1000), (1, 2000, 2000, 2000)])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        # The test database connection is older than the middleware
+        install_query_counter(connection)
+        self.addCleanup(connection.execute_wrappers.remove, count_query)
+
+    def request(self, view_name):
+        request = RequestFactory().get("/api/wallboxes/list/")
+        request.resolver_match = mock.Mock(view_name=view_name)
+        return request
+
+    def queries(self, view_name):
+        counts, total = request_queries.values[(("method", "GET"), ("view", view_name))]
+        return total
+
+    def test_sync_request(self):
+        def get_response(request):
+            return HttpResponse(str(Wallbox.objects.count()))
+
+        middleware = MetricsMiddleware(get_response)
+        self.assertFalse(iscoroutinefunction(middleware))
+        middleware(self.request("test-sync"))
+        self.assertEqual(self.queries("test-sync"), 1)
+
+    async def test_async_request(self):
+        async def get_response(request):
+            # Async views run their queries in a thread
+            return HttpResponse(str(await Wallbox.objects.acount()))
+
+        middleware = MetricsMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        await middleware(self.request("test-async"))
+        self.assertEqual(self.queries("test-async"), 1)
+
+    async def test_live_broadcaster_context(self):
+        broadcaster = live.WallboxBroadcaster()
+        queries = [0]
+        token = query_count.set(queries)
+        try:
+            with mock.patch.object(live, "LIVE_UPDATES_PORT", None):
+                queue = await broadcaster.subscribe()
+        finally:
+            query_count.reset(token)
+        broadcaster.unsubscribe(queue)
+        # The broadcaster read the wallboxes, but not for the request of its first client
+        self.assertEqual(queries, [0])
+
+    def test_token(self):
+        with mock.patch("api.views.METRICS_TOKEN", "secret"):
+            self.assertEqual(views.metrics(RequestFactory().get("/metrics/")).status_code, 401)
+            response = views.metrics(RequestFactory().get("/metrics/", headers={"Authorization": "Bearer secret"}))
+        self.assertEqual(response.status_code, 200)
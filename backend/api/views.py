@@ -1,13 +1,43 @@
 import datetime
+import hashlib
+import hmac
+import threading
 
 from django import forms
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection
+from django.db.models import Count, F, Max, Sum
+from django.db.models.functions import TruncMonth, TruncWeek, TruncYear
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date, quote_etag
 from django.utils.timezone import get_current_timezone
+from django.views.decorators.gzip import gzip_page
 from rest_framework import generics, permissions, serializers
+from rest_framework.exceptions import NotFound
 from rest_framework.authentication import BasicAuthentication
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from knox.views import LoginView as KnoxLoginView
 
-from api.models import ChargeSession, Wallbox, RFIDToken
-from api.serializers import ChargeSessionSerializer, WallboxSerializer, RFIDSerializer
+from api.cache import identity_generation, data_generation, SESSIONS, TOKENS
+from api.export import CSVRenderer, NDJSONRenderer, EXPORT_CHUNK_SIZE, EXPORT_FIELDS, async_chunks, chunks, csv_chunk, \
+    ndjson_chunk
+from api.live import EventStreamRenderer, wallbox_events
+from api.metrics import REGISTRY
+from api.models import ChargeSession, Wallbox, RFIDToken, PowerRollup, EnergyRollup
+from api.pagination import ChargeSessionPagination
+from api.serializers import ChargeSessionSerializer, WallboxSerializer, RFIDSerializer, PowerRollupSerializer, \
+    ValuesSerializer, EnergySerializer, ColumnsRenderer
+from api.telemetry import bucket_start
+from backend.settings import METRICS_FILE, METRICS_TOKEN, RESPONSE_CACHE_TIMEOUT, API_DB_CONCURRENCY
+
+response_cache = REGISTRY.counter("api_response_cache_total", "Lookups in the response cache of the lists, by result")
+# List requests querying the database and serializing at once, per process (see ConditionalListMixin)
+db_slots = threading.BoundedSemaphore(API_DB_CONCURRENCY)
 
 
 def validate(params, param_name, field_type, *args, **kwargs):
@@ -16,25 +46,161 @@ def validate(params, param_name, field_type, *args, **kwargs):
     return cleaned
 
 
+def metrics(request):
+    """
+    Prometheus metrics of the API and of the wallboxIO process. Requires the METRICS_TOKEN as bearer token, if one is
+    configured.
+    """
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        response = HttpResponse("Unauthorized", status=401, content_type="text/plain")
+        response["WWW-Authenticate"] = "Bearer"
+        return response
+    content = REGISTRY.render()
+    try:
+        with open(METRICS_FILE) as file:
+            content += file.read()
+    except FileNotFoundError:
+        pass
+    return HttpResponse(content, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 class LoginView(KnoxLoginView):
     authentication_classes = [BasicAuthentication]
 
 
-class ChargeSessionList(generics.ListAPIView):
+class ValuesListMixin:
+    """
+    Serializes list responses from values() rows (see ValuesSerializer), in a single query.
+    The response is identical to the one of the serializer_class, unless the compact format (ColumnsRenderer) is
+    requested.
+    """
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [ColumnsRenderer]
+
+    def list(self, request, *args, **kwargs):
+        serializer = ValuesSerializer(self.get_serializer())
+        represent = serializer.represent
+        if request.accepted_renderer.format == ColumnsRenderer.format:
+            represent = serializer.represent_columns
+        queryset = self.filter_queryset(self.get_queryset()).values(*serializer.values_fields)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(represent(page))
+        return Response(represent(queryset))
+
+
+class ConditionalListMixin:
+    """
+    Answers conditional requests for an unchanged list with 304 Not Modified, before the list is queried or serialized.
+    Lists that declare the data generations they depend on (see api.cache) are validated without any query, and their
+    responses are cached. Other lists are validated by an aggregate query over their table (list_state).
+    The validators also cover the (normalized) query parameters and renderer of the request, and the identity
+    generation (token names are part of the responses).
+    """
+    # Data generations the list depends on
+    generations = ()
+    # Otherwise: Aggregates that change whenever the list does (none disables validation)
+    list_state = {}
+    # The aggregate holding the time of the last modification, if there is one
+    last_modified_state = None
+    # Set if the response changes while the data doesn't (e.g. extrapolated values)
+    weak_etag = False
+    cache_key = None
+
+    def get_list_state(self):
+        if self.generations:
+            state = {name: data_generation(name) for name in self.generations}
+            return state, max(state.values()) // 10 ** 9
+        state = self.model.objects.aggregate(**self.list_state)
+        last_modified = state.get(self.last_modified_state)
+        return state, int(last_modified.timestamp()) if last_modified else None
+
+    def get(self, request, *args, **kwargs):
+        if not self.generations and not self.list_state:
+            return super().get(request, *args, **kwargs)
+        state, last_modified = self.get_list_state()
+        # Paginated responses link to other pages by absolute URL
+        key = repr((sorted(state.items()), identity_generation(), request.build_absolute_uri(request.path),
+                    sorted(request.query_params.lists()), request.accepted_renderer.format))
+        key = hashlib.sha1(key.encode()).hexdigest()
+        etag = quote_etag(key)
+        if self.weak_etag:
+            etag = "W/" + etag
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = self.get_cached_response(key)
+        if response is None:
+            # Only API_DB_CONCURRENCY requests query and serialize at once, further ones wait here
+            with db_slots:
+                response = super().get(request, *args, **kwargs)
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        # Caches must revalidate before they reuse a response
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    def response_cache_key(self, key):
+        # The browsable API shows the user, and tests and benchmarks use their own database
+        if not self.generations or not RESPONSE_CACHE_TIMEOUT or self.request.accepted_renderer.format == 'api':
+            return None
+        return f"api:response:{connection.settings_dict['NAME']}:{key}"
+
+    def get_cached_response(self, key):
+        self.cache_key = self.response_cache_key(key)
+        if self.cache_key is None:
+            return None
+        cached = cache.get(self.cache_key)
+        response_cache.inc(result="hit" if cached is not None else "miss")
+        if cached is None:
+            return None
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.cache_key is not None and isinstance(response, Response) and response.status_code == 200:
+            response.render()
+            cache.set(self.cache_key, (response.content, response['Content-Type']), timeout=RESPONSE_CACHE_TIMEOUT)
+        return response
+
+
+class ChargeSessionList(ConditionalListMixin, ValuesListMixin, generics.ListAPIView):
     """
-    Retrieve a list of all charge sessions.
+    Retrieve a list of all charge sessions, optionally filtered by start date (not_before, not_after), tokens (IDs)
+    and wallboxes (serials).
+    Pass page_size to receive the list in pages, the response then links to the next and previous page.
+    Pass format=columns for the compact format (see ValuesSerializer.represent_columns()).
     """
     model = ChargeSession
     serializer_class = ChargeSessionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = ChargeSessionPagination
+    generations = (SESSIONS, TOKENS)
+    # Supported values of the ordering parameter. Ties (session IDs are only unique per wallbox, or sessions starting
+    # at the same time) are ordered by primary key.
+    orderings = {
+        'sessionID': ('sessionID', 'id'),
+        '-sessionID': ('-sessionID', '-id'),
+        'started': ('started', 'id'),
+        '-started': ('-started', '-id'),
+    }
+
+    def get_ordering(self):
+        try:
+            ordering = validate(self.request.query_params, 'ordering', forms.ChoiceField, required=False,
+                                choices=[(key, key) for key in self.orderings])
+        except forms.ValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        return self.orderings[ordering or '-sessionID']
 
     def get_queryset(self):
-        queryset = ChargeSession.objects.all().order_by('-sessionID')
+        queryset = ChargeSession.objects.select_related('token').order_by(*self.get_ordering())
         try:
             not_before = validate(self.request.query_params, 'not_before', forms.DateField, required=False,
                                   localize=True)
             not_after = validate(self.request.query_params, 'not_after', forms.DateField, required=False)
             tokens = validate(self.request.query_params, 'tokens', forms.CharField, required=False, localize=True)
+            wallboxes = validate(self.request.query_params, 'wallboxes', forms.CharField, required=False)
         except forms.ValidationError as e:
             raise serializers.ValidationError(e.message)
         if not_before:
@@ -50,20 +216,73 @@ class ChargeSessionList(generics.ListAPIView):
             except ValueError:
                 raise serializers.ValidationError('tokens must be an integer list')
             queryset = queryset.filter(token__in=tokens)
+        if wallboxes:
+            queryset = queryset.filter(wallboxSerial__in=wallboxes.split(','))
         return queryset
 
 
-class WallboxList(generics.ListAPIView):
+@method_decorator(gzip_page, name='dispatch')
+class ChargeSessionExport(ChargeSessionList):
+    """
+    Export charge sessions as CSV (default) or NDJSON (format=ndjson), with the filters of the session list.
+    The export is streamed from a database cursor, so it is never held in memory as a whole. Under ASGI, it is
+    streamed asynchronously, so no thread is tied up while the client downloads it.
+    """
+    renderer_classes = [CSVRenderer, NDJSONRenderer]
+    pagination_class = None
+
+    # Exports are downloaded once
+    generations = ()
+
+    def list(self, request, *args, **kwargs):
+        rows = self.get_queryset().values(*EXPORT_FIELDS)
+        renderer = request.accepted_renderer
+        format_chunk = ndjson_chunk if renderer.format == 'ndjson' else csv_chunk
+        if isinstance(request._request, ASGIRequest):
+            content = async_chunks(rows.aiterator(chunk_size=EXPORT_CHUNK_SIZE), format_chunk)
+        else:
+            content = chunks(rows.iterator(chunk_size=EXPORT_CHUNK_SIZE), format_chunk)
+        response = StreamingHttpResponse(content, content_type=f"{renderer.media_type}; charset=utf-8")
+        filename = "__".join(["export"] + [request.query_params[param] for param in ('not_before', 'not_after')
+                                           if request.query_params.get(param)])
+        response['Content-Disposition'] = f'attachment; filename="{filename}.{renderer.format}"'
+        return response
+
+
+class WallboxList(ConditionalListMixin, ValuesListMixin, generics.ListAPIView):
     """
     Retrieve the current status of all known wallboxes.
     """
     model = Wallbox
     serializer_class = WallboxSerializer
-    queryset = Wallbox.objects.all()
+    queryset = Wallbox.objects.select_related('currentToken')
+    permission_classes = [permissions.IsAuthenticated]
+    list_state = {'count': Count('pk'), 'updated': Max('lastUpdated')}
+    last_modified_state = 'updated'
+    # The uptime is extrapolated to the time of the request
+    weak_etag = True
+
+
+class WallboxEvents(generics.GenericAPIView):
+    """
+    Stream the status of all wallboxes as server-sent events: A snapshot event with the wallbox list, then an update
+    event with the changed fields (and serial) of a wallbox whenever it changes. Requires an ASGI server.
+    """
+    renderer_classes = [EventStreamRenderer]
     permission_classes = [permissions.IsAuthenticated]
 
+    def get(self, request, *args, **kwargs):
+        if not isinstance(request._request, ASGIRequest):
+            # WSGI servers (like runserver) would wait for the end of the stream, clients poll the list instead
+            return Response({'detail': 'Live updates require an ASGI server'}, status=501)
+        response = StreamingHttpResponse(wallbox_events(), content_type="text/event-stream; charset=utf-8")
+        response['Cache-Control'] = 'no-cache'
+        # Keeps nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
 
-class RFIDTokenList(generics.ListAPIView):
+class RFIDTokenList(ConditionalListMixin, generics.ListAPIView):
     """
     Retrieve the current list of all RFID tokens.
     """
@@ -71,3 +290,85 @@ class RFIDTokenList(generics.ListAPIView):
     serializer_class = RFIDSerializer
     queryset = RFIDToken.objects.all()
     permission_classes = [permissions.IsAuthenticated]
+    generations = (TOKENS,)
+
+
+class EnergyAggregate(ConditionalListMixin, generics.ListAPIView):
+    """
+    Retrieve the charged energy and number of sessions per period (day, week, month or year, default month),
+    optionally per token and/or wallbox (group_by=token,wallbox). Sessions count for the day they started.
+    Computed from the energy rollups, not from the sessions themselves.
+    """
+    model = EnergyRollup
+    serializer_class = EnergySerializer
+    permission_classes = [permissions.IsAuthenticated]
+    generations = (SESSIONS,)
+    periods = {
+        'day': F('day'),
+        'week': TruncWeek('day'),
+        'month': TruncMonth('day'),
+        'year': TruncYear('day'),
+    }
+    groups = ('token', 'wallbox')
+
+    def get_queryset(self):
+        try:
+            period = validate(self.request.query_params, 'period', forms.ChoiceField, required=False,
+                              choices=[(key, key) for key in self.periods])
+            group_by = validate(self.request.query_params, 'group_by', forms.CharField, required=False)
+            not_before = validate(self.request.query_params, 'not_before', forms.DateField, required=False,
+                                  localize=True)
+            not_after = validate(self.request.query_params, 'not_after', forms.DateField, required=False)
+            tokens = validate(self.request.query_params, 'tokens', forms.CharField, required=False, localize=True)
+        except forms.ValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        group_by = group_by.split(',') if group_by else []
+        if any(group not in self.groups for group in group_by):
+            raise serializers.ValidationError(f'group_by must be a list of {", ".join(self.groups)}')
+        queryset = EnergyRollup.objects.all()
+        if not_before:
+            queryset = queryset.filter(day__gte=not_before)
+        if not_after:
+            queryset = queryset.filter(day__lte=not_after)
+        if tokens:
+            try:
+                tokens = [int(token) for token in tokens.split(',')]
+            except ValueError:
+                raise serializers.ValidationError('tokens must be an integer list')
+            queryset = queryset.filter(token__in=tokens)
+        group_by = [group for group in self.groups if group in group_by]
+        return queryset.annotate(period=self.periods[period or 'month']).values('period', *group_by).annotate(
+            sessionCount=Sum('sessions'), energy=Sum('chargedEnergy')).order_by('period', *group_by)
+
+
+class SessionPowerCurve(generics.ListAPIView):
+    """
+    Retrieve the power curve of a charge session (by wallbox serial and session ID), from the downsampled telemetry.
+    """
+    model = PowerRollup
+    serializer_class = PowerRollupSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        try:
+            resolution = validate(self.request.query_params, 'resolution', forms.TypedChoiceField, required=False,
+                                  choices=[(str(r), r) for r in PowerRollup.RESOLUTIONS], coerce=int,
+                                  empty_value=None)
+        except forms.ValidationError as e:
+            raise serializers.ValidationError(e.message)
+        wallbox, session_id = self.kwargs['wallbox'], self.kwargs['session_id']
+        session = ChargeSession.objects.filter(wallboxSerial=wallbox, sessionID=session_id).values_list(
+            'wallboxSerial', 'started', 'ended').first()
+        if session is None:
+            # Running sessions are only known to their wallbox
+            session = Wallbox.objects.filter(serial=wallbox, currentSessionID=session_id).values_list(
+                'serial', 'currentStartTime', 'currentEndTime').first()
+        if session is None or session[1] is None:
+            raise NotFound()
+        wallbox, started, ended = session
+        ended = ended or timezone.now()
+        if resolution is None:
+            resolution = PowerRollup.resolution_for(ended - started)
+        return PowerRollup.objects.filter(wallbox=wallbox, resolution=resolution,
+                                          start__gte=bucket_start(started, resolution),
+                                          start__lt=ended).order_by('start')
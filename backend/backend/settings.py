@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -46,6 +49,11 @@ SECRET_KEY = envstr("SECRET_KEY", 'django-insecure-+qfe#tj92590@@u&=1nza7a7t%-m5
 DEBUG = envbool("DEBUG", True)
 
 WALLBOX_IP = envstr("WALLBOX_IP", None)
+# Fleet mode: comma separated list of wallboxes that are polled concurrently. Defaults to the single WALLBOX_IP.
+WALLBOX_IPS = [ip.strip() for ip in (envstr("WALLBOX_IPS", None) or WALLBOX_IP or "").split(",") if ip.strip()]
+# Local address of wallboxIO. Wallboxes only reply to port 7090, other ports only work with the wallboxSimulator.
+WALLBOX_LOCAL_IP = envstr("WALLBOX_LOCAL_IP", "0.0.0.0")
+WALLBOX_LOCAL_PORT = envint("WALLBOX_LOCAL_PORT", 7090)
 
 if envstr("ALLOWED_HOSTS", None):
     ALLOWED_HOSTS = envstr("ALLOWED_HOSTS", None).split(",")
@@ -80,6 +88,16 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Export Prometheus metrics of the API and the wallboxIO process at /metrics/
+METRICS = envbool("METRICS", False)
+# wallboxIO runs in its own process and shares its metrics through this file
+METRICS_FILE = envstr("METRICS_FILE", os.path.join(tempfile.gettempdir(), "wallbox-ui-metrics.prom"))
+# Bearer token required to scrape /metrics/. Without one, /metrics/ is open to anyone who can reach the API.
+METRICS_TOKEN = envstr("METRICS_TOKEN", "")
+
+if METRICS:
+    MIDDLEWARE.insert(0, 'api.middleware.MetricsMiddleware')
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -144,6 +162,49 @@ if envstr("DB", None) == "mysql":
         }
     }
 
+# Cache
+# The API server and the wallboxIO process need to share the cache, so use one that works across processes.
+# The cache holds pickled data, so keep it in a directory only we can write to.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": envstr("CACHE_DIR", BASE_DIR / "cache"),
+    }
+}
+
+# Serialized responses of the session and token lists are cached for this long (seconds, 0 disables)
+RESPONSE_CACHE_TIMEOUT = envint("RESPONSE_CACHE_TIMEOUT", 3600)
+# List requests (sessions, wallboxes, tokens) using the database at once, per API server process
+API_DB_CONCURRENCY = envint("API_DB_CONCURRENCY", 16)
+
+# Logging
+# Compact single line records. Set LOG_LEVEL=DEBUG to log every report and push received from the wallboxes.
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "compact": {
+            "format": "{asctime} {levelname} {name} {message}",
+            "style": "{",
+        },
+    },
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+            "formatter": "compact",
+        },
+    },
+    "loggers": {
+        "api": {
+            "handlers": ["console"],
+            "level": envstr("LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -217,9 +278,33 @@ PASSWORD_HASHERS = [
 LOGOUT_REDIRECT_URL = "/"
 
 HEALTHCHECK_URL = envstr("HEALTHCHECK_URL", None)
+# Minimum time between two health check notifications, and their timeout (seconds)
+HEALTHCHECK_INTERVAL = envint("HEALTHCHECK_INTERVAL", 300)
+HEALTHCHECK_TIMEOUT = envint("HEALTHCHECK_TIMEOUT", 10)
+
+# Number of recently received wallbox datagrams kept in memory, dumped to the log on SIGUSR1 (0 disables)
+DATAGRAM_BUFFER_SIZE = envint("DATAGRAM_BUFFER_SIZE", 200)
+# Append every received wallbox datagram to this file, for replay with "wallboxIO --replay" (unset disables)
+CAPTURE_FILE = envstr("CAPTURE_FILE", None)
+# wallboxIO announces changed wallboxes to the live stream of the API on this local UDP port ("None" disables)
+LIVE_UPDATES_PORT = envint("LIVE_UPDATES_PORT", 7091)
+# Reports and pushes waiting to be written to the database. When the database falls behind, the oldest charging
+# reports and energy pushes are dropped (state changes never are).
+INGEST_QUEUE_SIZE = envint("INGEST_QUEUE_SIZE", 1000)
+
+# Retention of power telemetry in days ("None" keeps it forever)
+TELEMETRY_RETENTION_RAW = envint("TELEMETRY_RETENTION_RAW", 7)
+TELEMETRY_RETENTION = {
+    60: envint("TELEMETRY_RETENTION_1M", 90),
+    900: envint("TELEMETRY_RETENTION_15M", 730),
+    3600: envint("TELEMETRY_RETENTION_1H", "None"),
+}
 
 if DEBUG:
     CORS_ALLOWED_ORIGINS = [
         "http://localhost:3000",
     ]
     CORS_ALLOW_CREDENTIALS = True
+    # Conditional requests of the status page
+    CORS_ALLOW_HEADERS = (*default_headers, "if-none-match")
+    CORS_EXPOSE_HEADERS = ["ETag"]
@@ -19,6 +19,7 @@ from django.urls import path
 from knox import views as knox_views
 
 from api import views
+from backend.settings import METRICS
 
 admin.site.site_header = 'Wallbox Admin Panel'
 admin.site.site_title = 'Wallbox Admin'
@@ -26,9 +27,16 @@ admin.site.site_title = 'Wallbox Admin'
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/charge_sessions/list/', views.ChargeSessionList.as_view()),
+    path('api/charge_sessions/export/', views.ChargeSessionExport.as_view()),
+    path('api/charge_sessions/<str:wallbox>/<int:session_id>/power/', views.SessionPowerCurve.as_view()),
+    path('api/charge_sessions/energy/', views.EnergyAggregate.as_view()),
     path('api/wallboxes/list/', views.WallboxList.as_view()),
+    path('api/wallboxes/events/', views.WallboxEvents.as_view()),
     path('api/tokens/list/', views.RFIDTokenList.as_view()),
     path('api/login/', views.LoginView.as_view(), name='knox_login'),
     path('api/logout/', knox_views.LogoutView.as_view(), name='knox_logout'),
     path('api/logoutall/', knox_views.LogoutAllView.as_view(), name='knox_logoutall'),
 ]
+
+if METRICS:
+    urlpatterns.append(path('metrics/', views.metrics))
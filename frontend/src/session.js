@@ -102,12 +102,14 @@ export const session = reactive({
       });
     });
   },
-  sendGetToAPI(request, params) {
+  sendGetToAPI(request, params, options = {}) {
     let session_token = this.sessionToken;
     return new Promise(function (resolve, reject) {
       axios.get(API_BASE + request, {
+        ...options,
         headers: {
-          'Authorization': 'Token ' + session_token
+          'Authorization': 'Token ' + session_token,
+          ...options.headers,
         },
         params: params,
       }).then(response => {
@@ -138,6 +140,51 @@ export const session = reactive({
       });
     });
   },
+  streamFromAPI(request, onEvent) {
+    // Server-sent events, read with fetch() since EventSource can't send our token. Returns the controller to abort
+    // the stream and a promise that settles when the stream ends.
+    let controller = new AbortController();
+    let closed = fetch(API_BASE + request, {
+      headers: {
+        'Authorization': 'Token ' + this.sessionToken,
+        'Accept': 'text/event-stream',
+      },
+      signal: controller.signal,
+    }).then(async response => {
+      if (!response.ok) {
+        if (response.status == 401 || response.status == 403) {
+          session.logout();
+        }
+        throw new Error(response.statusText);
+      }
+      let reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+      let buffer = "";
+      for (; ;) {
+        let {value, done} = await reader.read();
+        if (done) {
+          return;
+        }
+        buffer += value;
+        let events = buffer.split("\n\n");
+        buffer = events.pop();
+        events.forEach(function (message) {
+          let name = "message";
+          let data = [];
+          message.split("\n").forEach(function (line) {
+            if (line.startsWith("event: ")) {
+              name = line.substring(7);
+            } else if (line.startsWith("data: ")) {
+              data.push(line.substring(6));
+            }
+          });
+          if (data.length > 0) {
+            onEvent(name, JSON.parse(data.join("\n")));
+          }
+        });
+      }
+    });
+    return {controller: controller, closed: closed};
+  },
   getAdminURL() {
     return API_ADMIN;
   }
@@ -1,14 +1,16 @@
 import humanizeDuration from "humanize-duration";
 
-export function download(filename, content, format) {
+export function download(filename, blob) {
+  let url = URL.createObjectURL(blob);
   let element = document.createElement('a');
-  element.setAttribute('href', 'data:' + format + ';charset=utf-8,' + encodeURIComponent(content));
+  element.setAttribute('href', url);
   element.setAttribute('download', filename);
 
   element.style.display = 'none';
   document.body.appendChild(element);
   element.click();
   document.body.removeChild(element);
+  URL.revokeObjectURL(url);
 }
 
 export function formatValue(value, unit) {
@@ -45,6 +47,28 @@ export function compareTime(timestamp) {
   }
 }
 
+// Compact list format of the API: Column arrays, related objects are referenced by their position in a dictionary.
+// Times are milliseconds since the epoch and decimals are numbers, both work with Date and the format functions.
+export const COLUMNS_FORMAT = "application/vnd.wallbox.columns+json";
+
+export function fromColumns(data) {
+  let names = Object.keys(data.columns);
+  let count = names.length ? data.columns[names[0]].length : 0;
+  let rows = new Array(count);
+  for (let i = 0; i < count; i++) {
+    rows[i] = {};
+  }
+  names.forEach(function (name) {
+    let column = data.columns[name];
+    let dictionary = data.dictionaries[name];
+    for (let i = 0; i < count; i++) {
+      let value = column[i];
+      rows[i][name] = dictionary !== undefined && value != null ? dictionary[value] : value;
+    }
+  });
+  return rows;
+}
+
 export function tokenToString(token) {
   if (token == null) {
     return "N/A";